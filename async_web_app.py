@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+from aiohttp import web
+from modules.bitrate_history import DOWNSAMPLE_LTTB, DOWNSAMPLE_MINMAX
+from web_app import WebApp
+
+class AsyncWebApp(WebApp):
+    """
+    WebAppと同じルートをaiohttpで提供する
+    HTTPサーバー・RTMP監視・OBS監視を1つのイベントループ上のタスクとして動かす
+    OBSへの操作は同期処理のため、ハンドラからは別スレッドで実行する
+    """
+    def __init__(self, config_ini, telemetry=None):
+        super().__init__(config_ini, start_monitors=False, telemetry=telemetry)
+        # ボットからの接続用、空の場合はTCPのみ
+        self.webhook_unix_socket = config_ini.get('http', 'webhook_unix_socket', fallback='').strip()
+
+    def _setup_routes(self):
+        self.app = web.Application(middlewares=[self._cors_preflight])
+        self.app.on_response_prepare.append(self._add_cors_headers)
+        self.app.router.add_post(self.webhook_path, self.webhook)
+        self.app.router.add_get('/bitrate', self.bitrate)
+        self.app.router.add_get('/avg_bitrate', self.avg_bitrate)
+        self.app.router.add_get('/bitrate/events', self.bitrate_events)
+        self.app.router.add_get('/alerts/events', self.alert_events)
+        self.app.router.add_get('/bitrate_stats', self.bitrate_stats)
+        self.app.router.add_get('/status', self.status)
+        self.app.router.add_get('/history', self.history)
+
+    # Flask-CORSのデフォルトと同じく全てのオリジンを許可する
+    @web.middleware
+    async def _cors_preflight(self, request, handler):
+        if request.method == 'OPTIONS':
+            return web.Response(status=204, headers={
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': request.headers.get('Access-Control-Request-Headers', '*'),
+            })
+        return await handler(request)
+
+    async def _add_cors_headers(self, request, response):
+        response.headers['Access-Control-Allow-Origin'] = '*'
+
+    def _json_response(self, data, status=200):
+        return web.Response(body=json.dumps(data).encode(), status=status, content_type='application/json')
+
+    def _create_response(self, data, success=True):
+        status = 'success' if success else 'error'
+        status_code = 200 if success else 400
+        return self._json_response({**data, 'status': status}, status_code)
+
+    async def webhook(self, request):
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return self._create_response({}, success=False)
+        data, success = await asyncio.to_thread(self._handle_webhook, data)
+        return self._create_response(data, success=success)
+
+    def _create_cached_response(self, cached, if_none_match):
+        headers = {'ETag': cached.etag, 'Cache-Control': 'no-cache'}
+        if self._is_not_modified(cached, if_none_match):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=cached.body, content_type='application/json', headers=headers)
+
+    async def bitrate(self, request):
+        cached = self._bitrate_response(request.query.get('stream'))
+        return self._create_cached_response(cached, request.headers.get('If-None-Match'))
+
+    async def avg_bitrate(self, request):
+        try:
+            window_sec = float(request.query['window']) if 'window' in request.query else None
+        except ValueError:
+            window_sec = None
+        if window_sec is not None and window_sec not in self.rtmp_monitor.windows_sec:
+            return self._create_response({'window': window_sec, 'windows': self.rtmp_monitor.windows_sec}, success=False)
+        cached = self._avg_bitrate_response(request.query.get('stream'), window_sec)
+        return self._create_cached_response(cached, request.headers.get('If-None-Match'))
+
+    async def bitrate_stats(self, request):
+        return self._json_response(self._bitrate_stats_data(request.query.get('stream')))
+
+    def _query_number(self, request, name, convert, default=None):
+        try:
+            return convert(request.query[name]) if name in request.query else default
+        except ValueError:
+            return default
+
+    async def history(self, request):
+        # 数十万サンプルの間引きはループを止めないよう別スレッドで行う
+        data = await asyncio.to_thread(
+            self._history_data,
+            request.query.get('stream'),
+            self._query_number(request, 'from', float),
+            self._query_number(request, 'to', float),
+            self._query_number(request, 'points', int, self.HISTORY_POINTS),
+            request.query.get('method', DOWNSAMPLE_LTTB)
+        )
+        if data is None:
+            return self._create_response({'methods': [DOWNSAMPLE_LTTB, DOWNSAMPLE_MINMAX]}, success=False)
+        return self._json_response(data)
+
+    async def status(self, request):
+        since, timeout = self._status_wait_params(
+            self._query_number(request, 'since', int),
+            self._query_number(request, 'timeout', float, self.STATUS_TIMEOUT_SEC)
+        )
+        if since is not None:
+            await self.status_updates.wait_async(since, timeout)
+        res = self._json_response(self._get_stream_status())
+        res.headers['Cache-Control'] = 'no-cache'
+        return res
+
+    async def bitrate_events(self, request, keepalive_sec=15):
+        stream_name = request.query.get('stream') or self.rtmp_monitor.streamkey
+        res = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        await res.prepare(request)
+        try:
+            await res.write(b'retry: 3000\n\n')
+            version = 0
+            while True:
+                new_version, snapshot = await self.rtmp_monitor.updates.wait_async(version, timeout=keepalive_sec)
+                if new_version == version:
+                    await res.write(b': keepalive\n\n')
+                    continue
+                version = new_version
+                event = self._format_bitrate_event(version, snapshot, stream_name)
+                if event is not None:
+                    await res.write(event)
+        except ConnectionResetError:
+            # クライアントの切断
+            pass
+        return res
+
+    async def alert_events(self, request, keepalive_sec=15):
+        alert_id = self._alert_start_id(request.headers.get('Last-Event-ID'))
+        res = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        await res.prepare(request)
+        try:
+            await res.write(b'retry: 3000\n\n')
+            while True:
+                new_version, _ = await self.alerts.updates.wait_async(alert_id, timeout=keepalive_sec)
+                if new_version == alert_id:
+                    await res.write(b': keepalive\n\n')
+                    continue
+                for alert in self.alerts.since(alert_id):
+                    await res.write(self._format_alert_event(alert))
+                alert_id = new_version
+        except ConnectionResetError:
+            # クライアントの切断
+            pass
+        return res
+
+    async def serve(self):
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        site = web.TCPSite(runner, '0.0.0.0', int(self.webhook_port))
+        await site.start()
+        self.logger.info(f'Started async web server on port {self.webhook_port}')
+        if self.webhook_unix_socket:
+            unix_site = web.UnixSite(runner, self.webhook_unix_socket)
+            await unix_site.start()
+            self.logger.info(f'Started async web server on {self.webhook_unix_socket}')
+        tasks = [
+            asyncio.create_task(self.rtmp_monitor.monitor()),
+            asyncio.create_task(self.obs_operator.obs_monitor.monitor()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await runner.cleanup()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import discord
 from discord.ext import commands
-import requests
 # from modules.scheduler import Scheduler
 from modules.logger import LoggerConfig
+from modules.alerts import AlertCooldown, alert_message, ALERT_SCENE
+from modules.rate_limiter import create_rate_limiter, rejected_message, NOTICE_DELAY_SEC
+from modules.telemetry import TelemetryReader, status_message
+from modules.webhook_client import create_webhook_client
 
-def discord_bot(config_ini):
+def discord_bot(config_ini, telemetry_name: str = None):
     intents = discord.Intents.default()
     intents.message_content = True
     bot = commands.Bot(
@@ -14,7 +18,19 @@ def discord_bot(config_ini):
     )
     is_command_control = config_ini.getboolean('discord', 'obs_command_control')
     tgt_channel_ids = [int(id) for id in config_ini['discord']['Target_Channel_IDs'].split(',') if id.strip()]
-    webhook_url = 'http://localhost:' + config_ini['http']['webhook_port'] + config_ini['http']['webhook_path']
+    # OBSの応答待ちでチャットの処理を止めないよう非同期で送る
+    webhook = create_webhook_client(config_ini)
+    # 監視の状態はweb appが書き込む共有メモリから読む
+    telemetry = TelemetryReader(telemetry_name)
+    # 荒らし等でOBSへの操作・返信が溢れないよう、ユーザー毎・コマンド毎・全体で回数を制限する
+    rate_limiter = create_rate_limiter(config_ini, 'discord')
+    notice_tasks = set()
+    # ビットレートの低下・回復とシーンの変化を通知する、Alert_Channel_IDsが空ならTarget_Channel_IDsへ
+    is_alert = config_ini.getboolean('discord', 'Alert', fallback=False)
+    is_scene_alert = config_ini.getboolean('discord', 'Alert_Scene_Change', fallback=True)
+    alert_channel_ids = [int(id) for id in config_ini.get('discord', 'Alert_Channel_IDs', fallback='').split(',') if id.strip()] or tgt_channel_ids
+    alert_cooldown = AlertCooldown(config_ini.getfloat('discord', 'Alert_Cooldown_Sec', fallback=60))
+    alert_tasks = []
 
     # scheduler = Scheduler()
     logger = LoggerConfig.get_logger(discord_bot.__name__)
@@ -23,6 +39,29 @@ def discord_bot(config_ini):
     @bot.event
     async def on_ready():
         print(f'Logged on as {bot.user}!')
+        # on_readyは再接続毎に呼ばれるため、購読は1回だけ始める
+        if is_alert and not alert_tasks:
+            alert_tasks.append(asyncio.create_task(webhook.subscribe('/alerts/events', _on_alert)))
+
+    async def _on_alert(alert: dict):
+        if alert['kind'] == ALERT_SCENE and not is_scene_alert:
+            return
+        message = alert_message(alert)
+        if not message:
+            return
+        for channel_id in alert_channel_ids:
+            channel = bot.get_channel(channel_id)
+            if channel is not None and alert_cooldown.should_send(channel_id, alert['kind']):
+                await channel.send(message)
+
+    bot_close = bot.close
+    async def close():
+        for task in alert_tasks:
+            task.cancel()
+        await webhook.close()
+        telemetry.close()
+        await bot_close()
+    bot.close = close
 
     @bot.event
     async def on_message(message):
@@ -33,18 +72,47 @@ def discord_bot(config_ini):
     def _is_in_target_channel(ctx):
         return ctx.channel.id in tgt_channel_ids
 
+    # 制限した分は後からまとめて1回だけ返信する
+    def _check_rate_limit(ctx, command: str):
+        user = str(ctx.author)
+        if rate_limiter.allow(user, command):
+            return True
+        if rate_limiter.reject(user):
+            task = asyncio.create_task(_send_rate_limit_notice(ctx))
+            notice_tasks.add(task)
+            task.add_done_callback(notice_tasks.discard)
+        return False
+
+    async def _send_rate_limit_notice(ctx):
+        await asyncio.sleep(NOTICE_DELAY_SEC)
+        rejected, users = rate_limiter.flush()
+        await ctx.send(rejected_message(rejected, users))
+
     @bot.command(name='hello')
     async def hello(ctx):
         if not _is_in_target_channel(ctx):
             return
         await ctx.reply('Hello!')
 
+    # 配信・シーン・ビットレートの状態
+    @bot.command(name='status')
+    async def status(ctx):
+        if not _is_in_target_channel(ctx):
+            return
+        await ctx.send(status_message(telemetry.read()))
+
     @bot.command(name='stream')
-    async def stream(ctx, args: str):
+    async def stream(ctx, args: str = None):
         if not _is_in_target_channel(ctx):
             return
         if not is_command_control:
             return
+        # 引数なしも制限の対象にするため、引数の確認は制限の後に行う
+        if not _check_rate_limit(ctx, 'stream'):
+            return
+        if args is None:
+            await ctx.send('コマンドの引数が間違っています')
+            return
 
         response = await _handle_stream_command(args)
         await _process_response(ctx, response)
@@ -55,6 +123,8 @@ def discord_bot(config_ini):
             return
         if not is_command_control:
             return
+        if not _check_rate_limit(ctx, 'pause'):
+            return
 
         response = await _handle_pause_command(args)
         await _process_response(ctx, response)
@@ -72,14 +142,14 @@ def discord_bot(config_ini):
         }
 
         if command in valid_commands:
-            return _post_to_webhook({'stream': valid_commands[command]}, webhook_url)
+            return await _post_to_webhook({'stream': valid_commands[command]})
         return None
 
     async def _handle_pause_command(command: str):
         if command == 'on' or command is None:
-            return _post_to_webhook({'pause': 'on'}, webhook_url)
+            return await _post_to_webhook({'pause': 'on'})
         elif command == 'off':
-            return _post_to_webhook({'pause': 'off'}, webhook_url)
+            return await _post_to_webhook({'pause': 'off'})
         return None
 
     async def _process_response(ctx, response):
@@ -96,6 +166,8 @@ def discord_bot(config_ini):
                 'init': '初期化します'
             }.get(response.json().get('stream'), '操作完了')
             await ctx.send(message)
+        elif response.timed_out:
+            await ctx.send('OBSの応答待ちがタイムアウトしました(後から実行される場合があります)')
         else:
             await ctx.send('コマンドの実行に失敗しました')
 
@@ -108,15 +180,8 @@ def discord_bot(config_ini):
         else:
             await ctx.send(f'コマンドエラーです: {error}')
 
-    def _post_to_webhook(data: dict, url: str) -> bool:
-        try:
-            response = requests.post(url, json=data)
-            response.raise_for_status()
-
-        except requests.RequestException as e:
-            print(f"Failed to send POST request: {e}")
-
-        finally:
-            return response
+    # OBSの操作が終わるまで待ち、結果をチャットに返す
+    async def _post_to_webhook(data: dict):
+        return await webhook.post(data, wait=True)
 
     return bot
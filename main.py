@@ -4,17 +4,20 @@ import multiprocessing as mp
 import twitch_bot
 from discord_bot import discord_bot
 from web_app import WebApp
+from async_web_app import AsyncWebApp
 from modules.logger import LoggerConfig
+from modules.telemetry import TelemetryWriter
 
-def run_twitch(config_ini):
-    twitch = twitch_bot.create(config_ini)
+def run_twitch(config_ini, telemetry_name):
+    twitch = twitch_bot.create(config_ini, telemetry_name)
     twitch.run()
 
-def run_discord(config_ini):
-    discord = discord_bot(config_ini)
+def run_discord(config_ini, telemetry_name):
+    discord = discord_bot(config_ini, telemetry_name)
     discord.run(config_ini['discord']['Token'])
 
 def main():
+    telemetry = None
     try:
         logger = LoggerConfig.get_logger('main')
         config_ini = configparser.ConfigParser()
@@ -26,11 +29,14 @@ def main():
         p_twitch  = None
         p_discord = None
 
+        # 監視の状態をボットのプロセスと共有する
+        telemetry = TelemetryWriter()
+
         if is_connect_twich:
             logger.info('startup twitch bot process')
             p_twitch =mp.Process(
                 target=run_twitch,
-                args=(config_ini,)
+                args=(config_ini, telemetry.name)
             )
             p_twitch.start()
 
@@ -38,11 +44,15 @@ def main():
             logger.info('startup discord bot process')
             p_discord =mp.Process(
                 target=run_discord,
-                args=(config_ini,)
+                args=(config_ini, telemetry.name)
             )
             p_discord.start()
 
-        web_app = WebApp(config_ini)
+        # flask:Flaskの開発サーバー、async:aiohttpでHTTPサーバーと監視を1つのイベントループで動かす
+        if config_ini.get('http', 'server_mode', fallback='flask') == 'async':
+            web_app = AsyncWebApp(config_ini, telemetry=telemetry)
+        else:
+            web_app = WebApp(config_ini, telemetry=telemetry)
         web_app.run()
 
 
@@ -57,5 +67,9 @@ def main():
             p_discord.terminate()
             p_discord.join()
 
+    finally:
+        if telemetry is not None:
+            telemetry.close()
+
 if __name__ == "__main__":
     main()
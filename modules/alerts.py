@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+from .broadcaster import Broadcaster
+
+ALERT_DROP = 'drop'       # ビットレートが閾値を下回った
+ALERT_RECOVER = 'recover' # 閾値以上に戻った、durationは低下していた秒数
+ALERT_SCENE = 'scene'     # 配信中にシーンが変わった
+
+class Alert(NamedTuple):
+    id: int
+    kind: str
+    timestamp: float # UNIX時刻
+    stream: str
+    bitrate: float
+    threshold: float
+    duration: float
+    scene: str
+
+
+class BitrateAlertDetector:
+    """
+    ビットレートの低下・回復を、それぞれ保持時間続いた場合のみ1回通知する
+    :param threshold: この値未満を低下とする[bps]
+    :param drop_hold_sec: 低下が続いたら通知するまでの秒数
+    :param recover_hold_sec: 回復が続いたら通知するまでの秒数
+    """
+    def __init__(self, threshold: float, drop_hold_sec: float = 3, recover_hold_sec: float = 5):
+        self.threshold = threshold
+        self.drop_hold_sec = drop_hold_sec
+        self.recover_hold_sec = recover_hold_sec
+        self.reset()
+
+    def reset(self):
+        self.dropped = False
+        self.dropped_at = None
+        self._since = None # 現在の状態と逆の値が続いている最初の時刻
+
+    def update(self, timestamp: float, bitrate: float):
+        """
+        :param timestamp: time.monotonic()等、単調増加する時刻[sec]
+        :return: (ALERT_DROP or ALERT_RECOVER, 低下していた秒数)、通知しない場合はNone
+        """
+        low = bitrate < self.threshold
+        if low == self.dropped:
+            self._since = None
+            return None
+        if self._since is None:
+            self._since = timestamp
+        if timestamp - self._since < (self.drop_hold_sec if low else self.recover_hold_sec):
+            return None
+        started, self._since = self._since, None
+        self.dropped = low
+        if low:
+            self.dropped_at = started
+            return ALERT_DROP, 0.0
+        return ALERT_RECOVER, started - self.dropped_at
+
+
+class AlertFeed:
+    """
+    通知を連番付きで直近keep件保持する、版番号を通知のidとする
+    購読者は最後に受け取ったidを渡し、それより新しい通知をまとめて受け取る(Broadcasterのように読み飛ばさない)
+    """
+    def __init__(self, keep: int = 50):
+        self.updates = Broadcaster()
+        self._recent = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def publish(self, kind: str, stream: str = '', bitrate: float = 0, threshold: float = 0,
+                duration: float = 0, scene: str = ''):
+        with self._lock:
+            alert = Alert(self.updates.version + 1, kind, time.time(), stream, bitrate, threshold, duration, scene or '')
+            self._recent.append(alert)
+            self.updates.publish(alert)
+        return alert
+
+    def since(self, alert_id: int):
+        with self._lock:
+            return [alert for alert in self._recent if alert.id > alert_id]
+
+
+class AlertCooldown:
+    """
+    ボットの通知をチャンネル毎に間引く、同じ種類の通知はcooldown_sec毎に1回まで
+    回復の通知は、そのチャンネルに低下を通知した場合のみ送る
+    """
+    def __init__(self, cooldown_sec: float = 60):
+        self.cooldown_sec = cooldown_sec
+        self._last = {} # (チャンネル, 種類) -> 送った時刻
+        self._dropped = set()
+
+    def should_send(self, channel, kind: str, now: float = None):
+        now = time.monotonic() if now is None else now
+        if kind == ALERT_RECOVER:
+            if channel not in self._dropped:
+                return False
+            self._dropped.discard(channel)
+            return True
+        last = self._last.get((channel, kind))
+        if last is not None and now - last < self.cooldown_sec:
+            return False
+        self._last[(channel, kind)] = now
+        if kind == ALERT_DROP:
+            self._dropped.add(channel)
+        return True
+
+
+def alert_message(alert: dict):
+    if alert['kind'] == ALERT_DROP:
+        return f"ビットレートが{alert['threshold'] / 1000:g} kbpsを下回りました(現在 {alert['bitrate'] / 1000:.0f} kbps)"
+    if alert['kind'] == ALERT_RECOVER:
+        return f"ビットレートが回復しました({alert['duration']:.0f}秒間低下、現在 {alert['bitrate'] / 1000:.0f} kbps)"
+    if alert['kind'] == ALERT_SCENE:
+        return f"シーンを{alert['scene']}に切り替えました"
+    return None
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+ビットレートとOBSのイベントを固定長レコードで記録する、起動毎に1ファイル
+書き込みはmmapへのコピーのみ、読み出しは時刻の二分探索で範囲を切り出す
+
+python -m modules.binary_log info logs/rtmp-20240101-120000.bin
+python -m modules.binary_log dump logs/rtmp-20240101-120000.bin --from 600 --to 900 --kind sample > trace.csv
+"""
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import NamedTuple
+from .fixed_text import encode_fixed
+
+MAGIC = b'RTMPLOG1'
+FORMAT_VERSION = 2
+# magic, version, record_size, created[UNIX時刻], count, stream数
+_HEADER = struct.Struct('<8sHHdQH')
+_STREAM_NAME_SIZE = 32
+MAX_STREAMS = 15
+_COUNT_OFFSET = 20
+# シーン名の表(version 2以降)、件数の後に(長さ1byte, UTF-8)を並べる
+_SCENE_TABLE_OFFSET = 512
+HEADER_SIZE = 4096
+_V1_HEADER_SIZE = 512
+
+# 時刻, 種類, ストリーム番号, 値(フラグ), 値1, 値2, 文字列
+_RECORD = struct.Struct('<dBBHxxxxdd16s')
+RECORD_SIZE = _RECORD.size # 48
+
+KIND_SAMPLE = 1    # 値1:bw_in, 値2:avg_bw_in, フラグ:statにストリームがあれば1
+KIND_SCENE = 2     # ストリーム番号:シーン名の表の番号、文字列:シーン名の先頭16byte
+KIND_STREAMING = 3 # フラグ:配信中なら1
+KIND_OBS = 4       # フラグ:OBSに接続中なら1
+KIND_NAMES = {KIND_SAMPLE: 'sample', KIND_SCENE: 'scene', KIND_STREAMING: 'streaming', KIND_OBS: 'obs'}
+NO_STREAM = 255
+
+GROW_RECORDS = 16384 # ファイルを広げる単位(約768KB)
+
+class Record(NamedTuple):
+    timestamp: float
+    kind: int
+    stream: int
+    flag: int
+    value1: float
+    value2: float
+    text: str
+
+
+class BinaryLogWriter:
+    """
+    追記専用、ファイルは先に広げておきmmap上に書き込む
+    複数スレッドから書き込めるよう追記はロックで直列化する
+    :param path: 書き込むファイル、既にある場合は上書きする
+    :param streams: 記録するストリーム名、先頭から番号を振る
+    """
+    def __init__(self, path: str, streams=()):
+        self.path = path
+        self.streams = []
+        self.scenes = []
+        self._scene_end = _SCENE_TABLE_OFFSET + 2
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'w+b')
+        self._capacity = GROW_RECORDS
+        self._file.truncate(HEADER_SIZE + RECORD_SIZE * self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.created = time.time()
+        for name in streams:
+            self._add_stream(name)
+        self._write_header()
+        struct.pack_into('<H', self._map, _SCENE_TABLE_OFFSET, 0)
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, MAGIC, FORMAT_VERSION, RECORD_SIZE, self.created, self.count, len(self.streams))
+        for i, name in enumerate(self.streams):
+            offset = _HEADER.size + i * _STREAM_NAME_SIZE
+            self._map[offset:offset + _STREAM_NAME_SIZE] = encode_fixed(name, _STREAM_NAME_SIZE).ljust(_STREAM_NAME_SIZE, b'\0')
+
+    def _add_stream(self, name):
+        if len(self.streams) >= MAX_STREAMS:
+            return NO_STREAM
+        self.streams.append(name)
+        return len(self.streams) - 1
+
+    def _stream_index(self, name):
+        try:
+            return self.streams.index(name)
+        except ValueError:
+            index = self._add_stream(name)
+            if index != NO_STREAM:
+                self._write_header()
+            return index
+
+    def _scene_index(self, name):
+        """
+        :return: シーン名の表の番号、表に入りきらない場合はNO_STREAM
+        """
+        try:
+            return self.scenes.index(name)
+        except ValueError:
+            pass
+        encoded = encode_fixed(name, 255)
+        if len(self.scenes) >= NO_STREAM or self._scene_end + 1 + len(encoded) > HEADER_SIZE:
+            return NO_STREAM
+        # 名前を書いてから件数を進める
+        self._map[self._scene_end] = len(encoded)
+        self._map[self._scene_end + 1:self._scene_end + 1 + len(encoded)] = encoded
+        self._scene_end += 1 + len(encoded)
+        self.scenes.append(name)
+        struct.pack_into('<H', self._map, _SCENE_TABLE_OFFSET, len(self.scenes))
+        return len(self.scenes) - 1
+
+    def _grow(self):
+        # Windowsでは割り当て中のファイルを広げられないため一度閉じる
+        self._map.close()
+        self._capacity += GROW_RECORDS
+        self._file.truncate(HEADER_SIZE + RECORD_SIZE * self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _append(self, timestamp, kind, stream=NO_STREAM, flag=0, value1=0.0, value2=0.0, text=b''):
+        if self._map is None:
+            return
+        if self.count >= self._capacity:
+            self._grow()
+        _RECORD.pack_into(self._map, HEADER_SIZE + RECORD_SIZE * self.count,
+                          timestamp, kind, stream, flag, value1, value2, text)
+        # レコードを書いてから件数を進める、読み出し側は件数までを読む
+        self.count += 1
+        struct.pack_into('<Q', self._map, _COUNT_OFFSET, self.count)
+
+    def write_sample(self, stream_name: str, bw_in: float, avg_bw_in: float, active: bool = True, timestamp: float = None):
+        """
+        :param active: statにストリームがあるか、配信が止まっている間はFalse
+        """
+        with self._lock:
+            self._append(time.time() if timestamp is None else timestamp, KIND_SAMPLE,
+                         self._stream_index(stream_name), int(active), bw_in, avg_bw_in)
+
+    def write_event(self, kind: int, flag: int = 0, text: str = '', timestamp: float = None):
+        """
+        :param text: KIND_SCENEの場合はシーン名、長さによらず表から読み出せる
+        """
+        with self._lock:
+            if self._map is None:
+                return
+            stream = self._scene_index(text) if kind == KIND_SCENE else NO_STREAM
+            self._append(time.time() if timestamp is None else timestamp, kind,
+                         stream, flag, text=encode_fixed(text, 16))
+
+    def close(self):
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            # 広げた分の空き領域を切り詰める
+            self._file.truncate(HEADER_SIZE + RECORD_SIZE * self.count)
+            self._file.close()
+
+
+class _TimestampView:
+    # レコードの時刻だけを並べた列として見せる、bisect用
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.count
+
+    def __getitem__(self, index):
+        return struct.unpack_from('<d', self.reader._map, self.reader.header_size + RECORD_SIZE * index)[0]
+
+
+class BinaryLogReader:
+    """
+    記録中のファイルも読める、ヘッダの件数までを有効なレコードとする
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.created, count, stream_count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or record_size != RECORD_SIZE:
+            self.close()
+            raise ValueError(f"Not a bitrate log: {path}")
+        self.version = version
+        self.header_size = HEADER_SIZE if version >= 2 else _V1_HEADER_SIZE
+        # 書き込み中のファイルは末尾が未使用の場合がある
+        self.count = min(count, (len(self._map) - self.header_size) // RECORD_SIZE)
+        self.streams = []
+        for i in range(stream_count):
+            offset = _HEADER.size + i * _STREAM_NAME_SIZE
+            self.streams.append(bytes(self._map[offset:offset + _STREAM_NAME_SIZE]).rstrip(b'\0').decode(errors='replace'))
+        self.scenes = self._read_scenes() if version >= 2 else []
+
+    def _read_scenes(self):
+        # 記録中に増えるため、シーンの記録を読む度に読み直す
+        scenes = []
+        offset = _SCENE_TABLE_OFFSET + 2
+        for _ in range(struct.unpack_from('<H', self._map, _SCENE_TABLE_OFFSET)[0]):
+            length = self._map[offset]
+            scenes.append(bytes(self._map[offset + 1:offset + 1 + length]).decode(errors='replace'))
+            offset += 1 + length
+        return scenes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def index_range(self, start: float = None, end: float = None):
+        """
+        :param start: 開始時刻(UNIX時刻[sec])、Noneの場合は先頭
+        :param end: 終了時刻(UNIX時刻[sec])、Noneの場合は末尾
+        :return: (先頭のレコード番号, 末尾の次のレコード番号)
+        """
+        view = _TimestampView(self)
+        lo = 0 if start is None else bisect_left(view, start)
+        hi = self.count if end is None else bisect_right(view, end)
+        return lo, max(lo, hi)
+
+    def raw(self, start: float = None, end: float = None):
+        """
+        :return: 範囲のレコードのmemoryview、コピーせずにmmapを参照する
+        """
+        lo, hi = self.index_range(start, end)
+        return memoryview(self._map)[self.header_size + RECORD_SIZE * lo:self.header_size + RECORD_SIZE * hi]
+
+    def records(self, start: float = None, end: float = None, kinds=None):
+        """
+        :param kinds: 読み出す種類、Noneの場合は全て
+        :return: Recordのイテレータ
+        """
+        view = self.raw(start, end)
+        try:
+            for timestamp, kind, stream, flag, value1, value2, text in _RECORD.iter_unpack(view):
+                if kinds is not None and kind not in kinds:
+                    continue
+                if kind == KIND_SCENE and stream != NO_STREAM and self.version >= 2:
+                    if stream >= len(self.scenes):
+                        self.scenes = self._read_scenes()
+                    if stream < len(self.scenes):
+                        yield Record(timestamp, kind, stream, flag, value1, value2, self.scenes[stream])
+                        continue
+                yield Record(timestamp, kind, stream, flag, value1, value2, text.rstrip(b'\0').decode(errors='replace'))
+        finally:
+            view.release()
+
+    def samples(self, stream_name: str = None, start: float = None, end: float = None):
+        """
+        :param stream_name: ストリーム名、Noneの場合は先頭のストリーム
+        :return: [(時刻, bw_in, avg_bw_in, statにストリームがあるか)]
+        """
+        # 長いストリーム名は切り詰めて記録している
+        stream = self.streams.index(encode_fixed(stream_name, _STREAM_NAME_SIZE).decode()) if stream_name else 0
+        return [
+            (record.timestamp, record.value1, record.value2, bool(record.flag))
+            for record in self.records(start, end, (KIND_SAMPLE,)) if record.stream == stream
+        ]
+
+
+def session_path(directory: str, keep: int = 10):
+    """
+    起動毎のファイル名を返し、古いファイルはkeep個まで残して消す
+    同じ秒に起動した場合も上書きしないよう、空のファイルを排他的に作ってから返す(重なったら-1, -2...を付ける)
+    """
+    os.makedirs(directory, exist_ok=True)
+    logs = sorted((name for name in os.listdir(directory) if name.startswith('rtmp-') and name.endswith('.bin')),
+                  key=lambda name: os.path.getmtime(os.path.join(directory, name)))
+    for name in logs[:max(0, len(logs) - keep + 1)]:
+        os.remove(os.path.join(directory, name))
+    stem = datetime.now().strftime('rtmp-%Y%m%d-%H%M%S')
+    suffix = 0
+    while True:
+        path = os.path.join(directory, stem + (f'-{suffix}' if suffix else '') + '.bin')
+        try:
+            open(path, 'xb').close()
+            return path
+        except FileExistsError:
+            suffix += 1
+
+
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+def main():
+    parser = argparse.ArgumentParser(description='ビットレート・イベントの記録を読む')
+    parser.add_argument('command', choices=['info', 'dump'])
+    parser.add_argument('path')
+    parser.add_argument('--from', dest='start', type=float, default=None, help='記録開始からの秒数')
+    parser.add_argument('--to', dest='end', type=float, default=None, help='記録開始からの秒数')
+    parser.add_argument('--kind', choices=['all'] + list(KIND_NAMES.values()), default='all')
+    parser.add_argument('--stream', default=None, help='sampleのストリーム名、省略時は先頭のストリーム')
+    args = parser.parse_args()
+
+    with BinaryLogReader(args.path) as reader:
+        start = None if args.start is None else reader.created + args.start
+        end = None if args.end is None else reader.created + args.end
+        if args.command == 'info':
+            counts = dict.fromkeys(KIND_NAMES.values(), 0)
+            last = reader.created
+            for record in reader.records():
+                counts[KIND_NAMES.get(record.kind, 'unknown')] = counts.get(KIND_NAMES.get(record.kind, 'unknown'), 0) + 1
+                last = record.timestamp
+            print(f'created : {_format_time(reader.created)}')
+            print(f'duration: {last - reader.created:.1f} sec')
+            print(f'streams : {", ".join(reader.streams)}')
+            print(f'records : {reader.count} {counts}')
+            return
+
+        if args.kind == 'sample':
+            # scene_replay.pyでそのまま読めるCSV
+            print('time,bitrate,avg_bitrate')
+            # 配信が止まっていた間はbitrateを空にする
+            for timestamp, bw_in, avg_bw_in, active in reader.samples(args.stream, start, end):
+                print(f'{timestamp - reader.created:.3f},{f"{bw_in:g}" if active else ""},{avg_bw_in:g}')
+            return
+        kinds = None if args.kind == 'all' else [kind for kind, name in KIND_NAMES.items() if name == args.kind]
+        print('time,kind,stream,flag,value1,value2,text')
+        for record in reader.records(start, end, kinds):
+            stream = reader.streams[record.stream] if record.kind == KIND_SAMPLE and record.stream < len(reader.streams) else ''
+            print(f'{record.timestamp - reader.created:.3f},{KIND_NAMES.get(record.kind, record.kind)},{stream},'
+                  f'{record.flag},{record.value1:g},{record.value2:g},{record.text}')
+
+if __name__ == '__main__':
+    main()
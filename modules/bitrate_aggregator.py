@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+# 確率的勾配法による分位点の逐次推定
+# 1サンプルあたり定数時間、刻み幅は直近の変動幅(EWMA)に比例させる
+class QuantileEstimator:
+    def __init__(self, q: float, alpha: float):
+        self.q = q
+        self.alpha = alpha
+        self.value = None
+        self.scale = 0.0
+
+    def add(self, x):
+        if self.value is None:
+            self.value = float(x)
+            return
+        diff = x - self.value
+        self.scale += self.alpha * (abs(diff) - self.scale)
+        step = 2 * self.alpha * self.scale
+        if diff > 0:
+            self.value = min(self.value + step * self.q, x)
+        elif diff < 0:
+            self.value = max(self.value - step * (1 - self.q), x)
+
+
+# 1つの時間窓の集計、値の追加・破棄ごとに合計と最小/最大候補を更新する
+class WindowStats:
+    QUANTILES = {'p10': 0.1, 'p50': 0.5}
+
+    def __init__(self, window_sec: float, interval_sec: float):
+        self.window_sec = window_sec
+        self.size = max(1, int(round(window_sec / interval_sec)))
+        self.values = deque()
+        self.total = 0
+        self._mins = deque() # 単調増加、先頭が最小
+        self._maxs = deque() # 単調減少、先頭が最大
+        self._index = 0
+        self._evicted = 0
+        alpha = 2 / (self.size + 1)
+        self.alpha = alpha
+        self.ewma = None
+        self.quantiles = {name: QuantileEstimator(q, alpha) for name, q in self.QUANTILES.items()}
+
+    def add(self, value):
+        index = self._index
+        self._index += 1
+        self.values.append(value)
+        self.total += value
+        if len(self.values) > self.size:
+            self.total -= self.values.popleft()
+            self._evicted += 1
+            # floatの積み残し誤差を窓1周ごとに精算する
+            if self._evicted >= self.size:
+                self._evicted = 0
+                self.total = sum(self.values)
+
+        oldest = index - len(self.values) + 1
+        while self._mins and self._mins[-1][1] >= value:
+            self._mins.pop()
+        self._mins.append((index, value))
+        while self._mins[0][0] < oldest:
+            self._mins.popleft()
+        while self._maxs and self._maxs[-1][1] <= value:
+            self._maxs.pop()
+        self._maxs.append((index, value))
+        while self._maxs[0][0] < oldest:
+            self._maxs.popleft()
+
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+        for estimator in self.quantiles.values():
+            estimator.add(value)
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def mean(self):
+        if not self.values:
+            return 0
+        return self.total / len(self.values)
+
+    @property
+    def min(self):
+        return self._mins[0][1] if self._mins else 0
+
+    @property
+    def max(self):
+        return self._maxs[0][1] if self._maxs else 0
+
+    def to_dict(self):
+        data = {
+            'avg': round(self.mean, 1),
+            'ewma': round(self.ewma or 0, 1),
+            'min': self.min,
+            'max': self.max,
+            'count': self.count,
+        }
+        for name, estimator in self.quantiles.items():
+            data[name] = round(estimator.value or 0, 1)
+        return data
+
+
+class BitrateAggregator:
+    """
+    複数の時間窓の平均・EWMA・最小/最大・分位点をまとめて更新する
+    :param windows_sec: 集計する時間窓[sec]
+    :param interval_sec: サンプルの間隔[sec]
+    """
+    def __init__(self, windows_sec=(1, 5, 30, 300), interval_sec: float = 0.5):
+        self.interval = interval_sec
+        self.windows = {float(sec): WindowStats(sec, interval_sec) for sec in sorted(set(windows_sec))}
+
+    def add(self, value):
+        for window in self.windows.values():
+            window.add(value)
+
+    def window(self, window_sec: float):
+        """
+        :return: WindowStats、集計していない時間窓の場合はNone
+        """
+        return self.windows.get(float(window_sec))
+
+    def mean(self, window_sec: float):
+        return self.windows[float(window_sec)].mean
+
+    def to_dict(self):
+        return {f'{sec:g}': window.to_dict() for sec, window in self.windows.items()}
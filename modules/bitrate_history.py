@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+DOWNSAMPLE_LTTB = 'lttb'     # 形を保つ間引き(Largest-Triangle-Three-Buckets)
+DOWNSAMPLE_MINMAX = 'minmax' # 区間毎の最小・最大、瞬断を必ず残す
+
+class _TimestampView:
+    # リングバッファを古い順に並べた時刻の列として見せる、bisect用
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return self.history.count
+
+    def __getitem__(self, index):
+        return self.history.timestamps[self.history._physical(index)]
+
+
+class BitrateHistory:
+    """
+    1ストリーム分の(時刻, ビットレート, 平均ビットレート)を固定長で保持する
+    値はarray('d')に詰めて持ち、上限を超えたら古いものから上書きする
+    配列は記録した分だけ伸ばし、上限に達してからは大きさを変えない
+    :param capacity: 保持するサンプル数
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array('d')
+        self.bitrates = array('d')
+        self.avg_bitrates = array('d')
+        self.count = 0
+        self._head = 0 # 次に書き込む位置
+        self._lock = threading.Lock()
+
+    def _physical(self, index):
+        return (self._head - self.count + index) % self.capacity
+
+    def add(self, timestamp: float, bitrate: float, avg_bitrate: float):
+        """
+        :param timestamp: UNIX時刻[sec]、前回以上の値
+        """
+        with self._lock:
+            head = self._head
+            if head == len(self.timestamps):
+                # 上限に達するまでは末尾に足す(head == count)
+                self.timestamps.append(timestamp)
+                self.bitrates.append(bitrate)
+                self.avg_bitrates.append(avg_bitrate)
+                self._head = (head + 1) % self.capacity
+                self.count += 1
+                return
+            self.timestamps[head] = timestamp
+            self.bitrates[head] = bitrate
+            self.avg_bitrates[head] = avg_bitrate
+            self._head = (head + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+
+    @property
+    def last_timestamp(self):
+        """
+        :return: 最新のサンプルの時刻、記録が無い場合はNone
+        """
+        with self._lock:
+            return self.timestamps[self._physical(self.count - 1)] if self.count else None
+
+    def _slice(self, values, start, stop):
+        first = self._physical(start)
+        if first + (stop - start) <= self.capacity:
+            return values[first:first + stop - start]
+        return values[first:] + values[:(first + stop - start) % self.capacity]
+
+    def range(self, start: float = None, end: float = None):
+        """
+        :param start: 開始時刻[sec]、Noneの場合は最古
+        :param end: 終了時刻[sec]、Noneの場合は最新
+        :return: (時刻, ビットレート, 平均ビットレート)、それぞれ古い順のarray
+        """
+        with self._lock:
+            view = _TimestampView(self)
+            lo = 0 if start is None else bisect_left(view, start)
+            hi = self.count if end is None else bisect_right(view, end)
+            if hi <= lo:
+                return array('d'), array('d'), array('d')
+            return (
+                self._slice(self.timestamps, lo, hi),
+                self._slice(self.bitrates, lo, hi),
+                self._slice(self.avg_bitrates, lo, hi)
+            )
+
+
+def lttb_indices(xs, ys, points: int):
+    """
+    Largest-Triangle-Three-Buckets、先頭と末尾は必ず残す
+    :return: 残すサンプルの位置
+    """
+    n = len(xs)
+    if points >= n:
+        return list(range(n))
+    if points < 3:
+        return [0, n - 1][:max(points, 0)]
+    indices = [0]
+    bucket = (n - 2) / (points - 2)
+    selected = 0
+    for i in range(points - 2):
+        start = int(i * bucket) + 1
+        stop = int((i + 1) * bucket) + 1
+        # 次の区間の平均点
+        next_start = stop
+        next_stop = min(int((i + 2) * bucket) + 1, n)
+        if next_start >= next_stop:
+            avg_x, avg_y = xs[n - 1], ys[n - 1]
+        else:
+            count = next_stop - next_start
+            avg_x = sum(xs[next_start:next_stop]) / count
+            avg_y = sum(ys[next_start:next_stop]) / count
+        ax, ay = xs[selected], ys[selected]
+        best = start
+        best_area = -1.0
+        for j in range(start, stop):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+        indices.append(best)
+        selected = best
+    indices.append(n - 1)
+    return indices
+
+def minmax_indices(ys, points: int):
+    """
+    points/2個の区間に分け、区間毎に最小・最大を時刻順に残す
+    :return: 残すサンプルの位置
+    """
+    n = len(ys)
+    if points >= n:
+        return list(range(n))
+    buckets = max(1, points // 2)
+    size = n / buckets
+    indices = []
+    for i in range(buckets):
+        start = int(i * size)
+        stop = max(int((i + 1) * size), start + 1)
+        lo = min(range(start, stop), key=ys.__getitem__)
+        hi = max(range(start, stop), key=ys.__getitem__)
+        indices.extend(sorted({lo, hi}))
+    return indices
+
+def downsample(timestamps, bitrates, avg_bitrates, points: int, method: str = DOWNSAMPLE_LTTB):
+    """
+    ビットレートを基準に間引き、同じ位置の平均ビットレートを合わせて返す
+    :return: (時刻, ビットレート, 平均ビットレート)のリスト
+    """
+    if method == DOWNSAMPLE_MINMAX:
+        indices = minmax_indices(bitrates, points)
+    elif method == DOWNSAMPLE_LTTB:
+        indices = lttb_indices(timestamps, bitrates, points)
+    else:
+        raise ValueError(f"Unknown downsample method: {method}")
+    return (
+        [timestamps[i] for i in indices],
+        [bitrates[i] for i in indices],
+        [avg_bitrates[i] for i in indices]
+    )
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+from .logger import LoggerConfig
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+class Broadcaster:
+    """
+    最新の値を版番号付きで保持し、更新を待っている購読者へ通知する
+    購読者は受け取った版番号を渡して次の更新を待つ。遅い購読者は途中の値を読み飛ばす
+    スレッド(wait)とasyncio(wait_async)のどちらからでも待てる
+    add_listenerで登録した関数は更新毎に発行元のスレッドで呼ばれる
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._version = 0
+        self._value = None
+        self._waiters = set() # (loop, future)
+        self._listeners = []
+        self.logger = LoggerConfig.get_logger(self.__class__.__name__)
+
+    def add_listener(self, callback):
+        """
+        :param callback: callback(版番号, 値)、発行元のスレッドで呼ばれるため重い処理はしないこと
+        """
+        self._listeners.append(callback)
+
+    def publish(self, value):
+        with self._cond:
+            self._version += 1
+            self._value = value
+            result = (self._version, value)
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_set_future_result, future, result)
+        for callback in self._listeners:
+            # 購読側の不具合で発行元の監視ループを止めない
+            try:
+                callback(*result)
+            except Exception as e:
+                self.logger.error(f"Listener error: {e!r}")
+        return result[0]
+
+    @property
+    def version(self):
+        return self._version
+
+    def latest(self):
+        """
+        :return: (版番号, 値)
+        """
+        with self._cond:
+            return self._version, self._value
+
+    def wait(self, since:int, timeout:float = None):
+        """
+        版番号がsinceより新しくなるまで待つ
+        :return: (版番号, 値)、タイムアウトした場合は現在の版番号と値
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._version > since, timeout)
+            return self._version, self._value
+
+    async def wait_async(self, since:int, timeout:float = None):
+        with self._cond:
+            if self._version > since:
+                return self._version, self._value
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.add(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return self.latest()
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+def encode_fixed(text: str, size: int):
+    """
+    固定長の領域に書く文字列をUTF-8にする、sizeを超える場合はマルチバイト文字の途中で切らない
+    :return: size byte以下のbytes
+    """
+    return text.encode()[:size].decode('utf-8', 'ignore').encode()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import NamedTuple
+from .logger import LoggerConfig
+
+COMMAND_QUEUED = 'queued'         # 受け付けた(結果を待たない場合)
+COMMAND_DONE = 'done'
+COMMAND_FAILED = 'failed'
+COMMAND_NOOP = 'noop'             # 既にその状態のため送らなかった
+COMMAND_SUPERSEDED = 'superseded' # 実行前に同じ種類の新しいコマンドで置き換えられた
+COMMAND_EXPIRED = 'expired'       # 期限までに実行できなかった
+
+class CommandResult(NamedTuple):
+    status: str
+    response: object = None
+
+    @property
+    def ok(self):
+        return self.status in (COMMAND_DONE, COMMAND_NOOP)
+
+
+class _Command:
+    __slots__ = ('name', 'func', 'key', 'deadline', 'is_noop', 'future')
+
+    def __init__(self, name, func, key, deadline, is_noop):
+        self.name = name
+        self.func = func
+        self.key = key
+        self.deadline = deadline
+        self.is_noop = is_noop
+        self.future = Future()
+
+
+class OBSCommandQueue:
+    """
+    OBSへの操作を1つのスレッドで順に実行する
+    webhook・自動切替等の複数のスレッドから積まれても、OBSへは1つずつ届く
+    同じkeyのコマンドが実行待ちの間に積まれた場合は古い方を捨て、最新のものだけを実行する
+    :param default_deadline_sec: 積んでから実行を始めるまでの期限[sec]、過ぎたものは実行しない
+    """
+    def __init__(self, default_deadline_sec: float = 5):
+        self.default_deadline_sec = default_deadline_sec
+        self._pending = deque()
+        self._by_key = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self.logger = LoggerConfig.get_logger(self.__class__.__name__)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='obs-command')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, name: str, func, key: str = None, deadline_sec: float = None, is_noop=None):
+        """
+        :param func: OBSOperatorのメソッド等、Falseを返した場合は失敗とする
+        :param key: 同じkeyの実行待ちのコマンドはまとめる、Noneならまとめない
+        :param is_noop: 実行直前に呼び、Trueなら送らずにCOMMAND_NOOPとする
+        :return: CommandResultが入るconcurrent.futures.Future
+        """
+        deadline = time.monotonic() + (self.default_deadline_sec if deadline_sec is None else deadline_sec)
+        command = _Command(name, func, key, deadline, is_noop)
+        with self._cond:
+            if self._stopped:
+                command.future.set_result(CommandResult(COMMAND_EXPIRED))
+                return command.future
+            if key is not None:
+                previous = self._by_key.get(key)
+                if previous is not None:
+                    # 古い方は実行待ちの列に残し、取り出した時に読み飛ばす
+                    previous.future.set_result(CommandResult(COMMAND_SUPERSEDED))
+                    self.logger.debug(f"Command {previous.name} superseded by {name}")
+                self._by_key[key] = command
+            self._pending.append(command)
+            self._cond.notify()
+        return command.future
+
+    def _next(self):
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            command = self._pending.popleft()
+            if command.key is not None and self._by_key.get(command.key) is command:
+                del self._by_key[command.key]
+            return command
+
+    def _run(self):
+        while True:
+            command = self._next()
+            if command is None:
+                return
+            if command.future.done():
+                continue
+            if self._stopped or time.monotonic() > command.deadline:
+                self.logger.warning(f"Command {command.name} expired")
+                command.future.set_result(CommandResult(COMMAND_EXPIRED))
+                continue
+            command.future.set_result(self._execute(command))
+
+    def _execute(self, command):
+        try:
+            if command.is_noop is not None and command.is_noop():
+                return CommandResult(COMMAND_NOOP)
+            response = command.func()
+        except Exception as e:
+            self.logger.error(f"Command {command.name} error: {e}")
+            return CommandResult(COMMAND_FAILED)
+        return CommandResult(COMMAND_DONE if response else COMMAND_FAILED, response)
@@ -1,23 +1,141 @@
 # -*- coding: utf-8 -*-
+import json
+import threading
+import websocket
 from obswebsocket import obsws, requests, events, exceptions
 from .logger import LoggerConfig
 
+# 接続が切れている時に発生する例外、再接続して1度だけやり直す
+_CONNECTION_ERRORS = (
+    exceptions.ConnectionFailure,
+    websocket.WebSocketConnectionClosedException,
+    ConnectionError,
+)
+
+# obswsにRequestBatch(op 8/9)を追加したもの
+class OBSBatchClient(obsws):
+    # 受信スレッドはop 9を扱わないため、受信スレッドの開始前(認証後)に受信処理を差し替えて横取りする
+    def _auth(self):
+        super()._auth()
+        self.ws.recv = self._wrap_recv(self.ws.recv)
+
+    def _wrap_recv(self, recv):
+        def _recv():
+            message = recv()
+            if message and '"results"' in message:
+                result = json.loads(message)
+                if result.get('op') == 9:
+                    request_id = result['d']['requestId']
+                    if request_id in self.events:
+                        self.answers[request_id] = result['d']
+                        self.events[request_id].set()
+                    return '' # 受信スレッドは空文字を読み飛ばす
+            return message
+        return _recv
+
+    def call_batch(self, objs, halt_on_failure:bool = False, execution_type:int = 0):
+        """
+        複数のリクエストを1つのRequestBatchで送り、まとめて応答を受け取る
+        :param objs: リクエストのリスト(obswebsocket.requests)
+        :param halt_on_failure: 失敗したリクエスト以降を実行しない
+        :param execution_type: 0:SerialRealtime 1:SerialFrame 2:Parallel
+        :return: 応答が入ったリクエストのリスト、実行されなかったリクエストはstatusがNoneのまま
+        """
+        if self.legacy:
+            raise exceptions.ObjectError("RequestBatch is not supported by the legacy protocol")
+        message_id = str(self.id)
+        self.id += 1
+        event = threading.Event()
+        self.events[message_id] = event
+
+        payload = {
+            "op": 8,
+            "d": {
+                "requestId": message_id,
+                "haltOnFailure": halt_on_failure,
+                "executionType": execution_type,
+                "requests": [{"requestType": obj.name, "requestData": obj.data()} for obj in objs]
+            }
+        }
+        self.ws.send(json.dumps(payload))
+
+        event.wait(self.timeout)
+        self.events.pop(message_id)
+
+        if message_id in self.answers:
+            results = self.answers.pop(message_id).get('results', [])
+            for obj, result in zip(objs, results):
+                obj.input(result.get('responseData', {}), result['requestStatus']['result'])
+            return objs
+        raise exceptions.MessageTimeout("No answer for batch {}".format(message_id))
+
+
 class OBSController():
-    def __init__(self,  host:str, port:int, password:str):
-        self.ws = obsws(host, port, password)
+    def __init__(self,  host:str, port:int, password:str, request_timeout:float = 10):
+        self.ws = OBSBatchClient(host, port, password, timeout=request_timeout, on_disconnect=self._on_disconnect)
         self.logger = LoggerConfig.get_logger(self.__class__.__name__)
+        # 認証済みの接続を使い回す、リクエストは複数スレッドから来るためロックで直列化する
+        self._lock = threading.RLock()
+        self._is_connected = False
+
+        # (シーン名, ソース名) -> sceneItemId、初回に一括取得し以降はOBSのイベントで更新する
+        self._scene_items = None
+        self._scene_items_dirty = False
+        self._cache_lock = threading.Lock()
+        self.ws.register(self._on_scene_item_created, events.SceneItemCreated)
+        self.ws.register(self._on_scene_item_removed, events.SceneItemRemoved)
+        self.ws.register(self._on_scene_name_changed, events.SceneNameChanged)
+        self.ws.register(self._on_scene_removed, events.SceneRemoved)
+        self.ws.register(self._on_scene_collection_changed, events.CurrentSceneCollectionChanging)
+        self.ws.register(self._on_scene_collection_changed, events.CurrentSceneCollectionChanged)
+
+    def _on_disconnect(self, obs):
+        self._is_connected = False
+
+    def _ensure_connection(self):
+        if not self._is_connected:
+            # 切断中のイベントは受け取れないためキャッシュを作り直す
+            self._invalidate_scene_items()
+            self.ws.connect()
+            self._is_connected = True
+            self.logger.info("Connected to OBS")
+
+    def _drop_connection(self):
+        self._is_connected = False
+        try:
+            if self.ws.ws is not None:
+                self.ws.disconnect()
+        except Exception as e:
+            self.logger.debug(f"Error while disconnecting: {e}")
+
+    def close(self):
+        with self._lock:
+            self._drop_connection()
 
     # deco
     def connection(func):
         def _wrapper(self, *args, **kwargs):
-            try:
-                self.ws.connect()
-                return func(self, *args, **kwargs)
-            except Exception as e:
-                print(f"Error: {e}")
+            with self._lock:
+                for attempt in range(2):
+                    reused = self._is_connected
+                    try:
+                        self._ensure_connection()
+                        return func(self, *args, **kwargs)
+                    except _CONNECTION_ERRORS as e:
+                        self._drop_connection()
+                        if not reused:
+                            self.logger.error(f"Error: {e}")
+                            return False
+                        self.logger.warning(f"OBS connection lost, reconnecting: {e!r}")
+                    except exceptions.MessageTimeout as e:
+                        # 送信済みのリクエストは再送しない
+                        self.logger.error(f"Error: {e}")
+                        self._drop_connection()
+                        return False
+                    except Exception as e:
+                        self.logger.error(f"Error: {e}")
+                        return False
                 return False
-            finally:
-                self.ws.disconnect()
         return _wrapper
 
     @connection
@@ -40,7 +158,7 @@ class OBSController():
 
     @connection
     def show_source(self, scene_name, source_name):
-        scene_item_id = self._get_scene_item_id(source_name)
+        scene_item_id = self._get_scene_item_id(source_name, scene_name)
         if scene_item_id:
             response = self.ws.call(requests.SetSceneItemEnabled(
                 sceneName=scene_name,
@@ -54,7 +172,7 @@ class OBSController():
 
     @connection
     def hide_source(self, scene_name, source_name):
-        scene_item_id = self._get_scene_item_id(source_name)
+        scene_item_id = self._get_scene_item_id(source_name, scene_name)
         if scene_item_id:
             response = self.ws.call(requests.SetSceneItemEnabled(
                 sceneName=scene_name,
@@ -68,8 +186,7 @@ class OBSController():
 
     @connection
     def set_source_in_scene_visibility(self, scene_name, source_name, visibility):
-        scene_item_id = self._get_scene_item_id(source_name)
-        print(scene_item_id)
+        scene_item_id = self._get_scene_item_id(source_name, scene_name)
         visibility = True if visibility == 'visible' else False
         if scene_item_id:
             response = self.ws.call(requests.SetSceneItemEnabled(
@@ -85,10 +202,18 @@ class OBSController():
 
     @connection
     def set_text_source(self, source_name, new_text):
-        response = self.ws.call(requests.GetInputSettings(inputName=source_name))
-        settings = response.getInputSettings()
-        settings['text'] = new_text
-        response = self.ws.call(requests.SetInputSettings(inputName=source_name, inputSettings=settings))
+        # overlayで既存の設定にtextだけを上書きするため、事前の取得は不要
+        response = self.ws.call(requests.SetInputSettings(inputName=source_name, inputSettings={'text': new_text}, overlay=True))
+        return response
+
+    @connection
+    def call_batch(self, *reqs, halt_on_failure:bool = True):
+        """
+        複数のリクエストを1往復で実行する
+        :return: 応答が入ったリクエストのリスト
+        """
+        response = self.ws.call_batch(list(reqs), halt_on_failure=halt_on_failure)
+        self.logger.info(f"Batch executed: {', '.join(f'{req.name}={req.status}' for req in response)}")
         return response
 
     @connection
@@ -104,18 +229,81 @@ class OBSController():
         scene_item_id = response2.getSceneItemId()
         return scene_item_id
 
-    def _get_scene_item_id(self, source_name):
-        scene_list = self.ws.call(requests.GetSceneList())
-        scenes = scene_list.getScenes()
+    def _get_scene_item_id(self, source_name, scene_name=None):
+        """
+        キャッシュからsceneItemIdを取得する、scene_nameがNoneの場合は最初に見つかったシーンのもの
+        :return: sceneItemId、見つからない場合はFalse
+        """
+        scene_items = self._scene_items
+        if scene_items is None:
+            scene_items = self._load_scene_items()
+        if scene_name is not None:
+            return scene_items.get((scene_name, source_name), False)
+        for (scene, source), scene_item_id in scene_items.items():
+            if source == source_name:
+                return scene_item_id
+        return False
+
+    def _load_scene_items(self):
+        with self._cache_lock:
+            self._scene_items_dirty = False
+        scene_items = {}
+        scenes = self.ws.call(requests.GetSceneList()).getScenes()
         for scene in scenes:
             scene_name = scene['sceneName']
-            try:
-                response = self.ws.call(requests.GetSceneItemId(sceneName=scene_name, sourceName=source_name))
-                scene_item_id = response.getSceneItemId()
-                return scene_item_id
-            except Exception:
+            response = self.ws.call(requests.GetSceneItemList(sceneName=scene_name))
+            if not response.status:
                 continue
-        return False
+            for item in response.getSceneItems():
+                scene_items.setdefault((scene_name, item['sourceName']), item['sceneItemId'])
+        with self._cache_lock:
+            # 取得中にシーン構成が変わった場合は次回取り直す
+            if not self._scene_items_dirty:
+                self._scene_items = scene_items
+        self.logger.info(f"Loaded {len(scene_items)} scene items from {len(scenes)} scenes")
+        return scene_items
+
+    def _invalidate_scene_items(self):
+        with self._cache_lock:
+            self._scene_items = None
+            self._scene_items_dirty = True
+
+    # OBSのイベント、受信スレッドから呼ばれる
+    def _on_scene_item_created(self, event):
+        with self._cache_lock:
+            self._scene_items_dirty = True
+            if self._scene_items is not None:
+                self._scene_items.setdefault((event.getSceneName(), event.getSourceName()), event.getSceneItemId())
+
+    def _on_scene_item_removed(self, event):
+        with self._cache_lock:
+            self._scene_items_dirty = True
+            if self._scene_items is not None:
+                key = (event.getSceneName(), event.getSourceName())
+                if self._scene_items.get(key) == event.getSceneItemId():
+                    del self._scene_items[key]
+
+    def _on_scene_name_changed(self, event):
+        old_name, new_name = event.getOldSceneName(), event.getSceneName()
+        with self._cache_lock:
+            self._scene_items_dirty = True
+            if self._scene_items is not None:
+                self._scene_items = {
+                    (new_name if scene == old_name else scene, source): scene_item_id
+                    for (scene, source), scene_item_id in self._scene_items.items()
+                }
+
+    def _on_scene_removed(self, event):
+        scene_name = event.getSceneName()
+        with self._cache_lock:
+            self._scene_items_dirty = True
+            if self._scene_items is not None:
+                self._scene_items = {
+                    key: scene_item_id for key, scene_item_id in self._scene_items.items() if key[0] != scene_name
+                }
+
+    def _on_scene_collection_changed(self, event):
+        self._invalidate_scene_items()
 
     @connection
     def get_stream_status(self):
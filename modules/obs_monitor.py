@@ -1,81 +1,207 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import random
 import threading
-from obswebsocket import obsws, requests, exceptions
+import time
+import websocket
+from typing import NamedTuple
+from obswebsocket import obsws, requests, events, exceptions
+from .broadcaster import Broadcaster
 from .logger import LoggerConfig
 
+# OBSの状態、変わる毎に作り直して丸ごと差し替えるため読み出し側はロック不要
+class OBSState(NamedTuple):
+    version: int
+    running: bool
+    streaming: bool
+    scene: str
+
 class OBSMonitor:
-    def __init__(self, host:str, port:int, password:str):
-        self.is_obs_running = False
-        self.is_obs_streaming = False
-        self.scene_name = None
+    def __init__(self, host:str, port:int, password:str, sync_interval_sec:float = 30,
+                 heartbeat_interval_sec:float = 2, heartbeat_max_missed:int = 3,
+                 reconnect_min_sec:float = 1, reconnect_max_sec:float = 30):
+        """
+        :param sync_interval_sec: 状態はOBSのイベントで更新する、取りこぼし対策として問い合わせる間隔[sec]
+        :param heartbeat_interval_sec: 死活確認のリクエストを送る間隔[sec]、応答待ちの上限も兼ねる
+        :param heartbeat_max_missed: 連続でこの回数応答が無ければ切断して再接続する
+                                     無応答の後は間隔を空けずに送るため、応答が途絶えてから検知するまで
+                                     最長 heartbeat_interval_sec * (heartbeat_max_missed + 1) 秒(既定値で8秒)
+        :param reconnect_min_sec: 再接続の待ち時間の初期値[sec]、失敗する毎に倍にする
+        :param reconnect_max_sec: 再接続の待ち時間の上限[sec]
+        """
+        self.state = OBSState(0, False, False, None)
+        self.sync_interval = sync_interval_sec
+        self.heartbeat_interval = heartbeat_interval_sec
+        self.heartbeat_max_missed = heartbeat_max_missed
+        self.reconnect_min = reconnect_min_sec
+        self.reconnect_max = reconnect_max_sec
+        self.liveness_latency = None #直近のハートビートの応答時間[sec]
+        self.last_heartbeat = None #直近のハートビートの応答時刻(time.monotonic)
+        self.missed_heartbeats = 0
+        self._call_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self.updates = Broadcaster() # 状態が変わる毎にOBSStateを発行
         self.logger = LoggerConfig.get_logger(self.__class__.__name__)
-        self.ws = obsws(host, port, password, on_connect=self.on_connect, on_disconnect=self.on_disconnect)
+        # 応答待ちがハートビートの待ち時間より長いと、待ちを打ち切った後も_call_lockを持ち続け
+        # 次のハートビートや状態の問い合わせを止めるため、同じ長さにする
+        self.ws = obsws(host, port, password, timeout=heartbeat_interval_sec,
+                        on_connect=self.on_connect, on_disconnect=self.on_disconnect)
+        self.ws.register(self.on_stream_state_changed, events.StreamStateChanged)
+        self.ws.register(self.on_program_scene_changed, events.CurrentProgramSceneChanged)
+        self.ws.register(self.on_exit_started, events.ExitStarted)
+
+    # 読み出し側との互換、同時に複数の値を使う場合はstateを1回だけ読むこと
+    @property
+    def is_obs_running(self):
+        return self.state.running
+
+    @property
+    def is_obs_streaming(self):
+        return self.state.streaming
+
+    @property
+    def scene_name(self):
+        return self.state.scene
+
+    def _set_state(self, **changes):
+        # 値が変わった時だけ版番号を進めて差し替える、発行順が入れ替わらないようロック内で発行する
+        with self._state_lock:
+            state = self.state
+            if all(getattr(state, key) == value for key, value in changes.items()):
+                return
+            state = state._replace(version=self.updates.version + 1, **changes)
+            self.state = state
+            self.updates.publish(state)
 
     def on_connect(self, obs):
-        self.is_obs_running = True
+        self._set_state(running=True)
         self.logger.info("Connected to OBS")
 
     def on_disconnect(self, obs):
         self._condition_init()
         self.logger.info("Disconnected from OBS")
 
+    # OBSのイベント、受信スレッドから呼ばれる
+    def on_stream_state_changed(self, event):
+        self._set_state(streaming=event.getOutputActive())
+        self.logger.info(f"Stream state changed: {event.getOutputState()}")
+
+    def on_program_scene_changed(self, event):
+        scene_name = event.getSceneName()
+        self._set_state(scene=scene_name)
+        self.logger.info(f"Program scene changed: {scene_name}")
+
+    def on_exit_started(self, event):
+        self._condition_init()
+        self.logger.info("OBS is exiting")
+
     def _condition_init(self):
-        self.is_obs_running = False
-        self.is_obs_streaming = False
-        self.scene_name = None
+        # 3つの値を1回で差し替え、読み出し側が途中の状態を見ないようにする
+        self._set_state(running=False, streaming=False, scene=None)
+
+    @property
+    def liveness_latency_ms(self):
+        if self.liveness_latency is None:
+            return None
+        return round(self.liveness_latency * 1000, 1)
+
+    def _call(self, request):
+        # 受信スレッド以外の複数スレッドから呼ぶため直列化する
+        with self._call_lock:
+            return self.ws.call(request)
+
+    def _reconnect_delay(self, attempt:int):
+        # 指数バックオフ、複数台が同時に再接続しないよう揺らぎを入れる
+        delay = min(self.reconnect_max, self.reconnect_min * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
 
     async def check_obs_running(self):
+        attempt = 0
         while True:
+            if self.is_obs_running:
+                attempt = 0
+                await asyncio.sleep(min(self.heartbeat_interval, 1))
+                continue
+            try:
+                self.logger.info('Trying to connect to OBS...')
+                await asyncio.wait_for(
+                    asyncio.to_thread(self.ws.connect),
+                    timeout=5
+                )
+                self.missed_heartbeats = 0
+                # 接続前の状態はイベントで届かないため一度問い合わせる
+                await self._update_stream_status()
+                continue
+            except (exceptions.ConnectionFailure, asyncio.TimeoutError, websocket.WebSocketException, OSError):
+                self._condition_init()
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            self.logger.info(f'Retry connecting to OBS in {delay:.1f} sec')
+            await asyncio.sleep(delay)
+
+    # アプリケーションレベルのハートビート、応答が途絶えた接続を検知して切断する
+    async def heartbeat(self):
+        while True:
+            # 無応答だった場合は待たずに次を送り、切断の判定を早める
+            if self.missed_heartbeats == 0 or not self.is_obs_running:
+                await asyncio.sleep(self.heartbeat_interval)
             if not self.is_obs_running:
-                try:
-                    self.logger.info('Trying to connect to OBS...')
-                    await asyncio.wait_for(
-                        asyncio.to_thread(self.ws.connect),
-                        timeout=5
-                    )
-                except (exceptions.ConnectionFailure, asyncio.TimeoutError):
-                    self._condition_init()
-            await asyncio.sleep(10)
+                continue
+            start = time.perf_counter()
+            try:
+                res = await asyncio.wait_for(
+                    asyncio.to_thread(self._call, requests.GetVersion()),
+                    timeout=self.heartbeat_interval
+                )
+                if res.status:
+                    self.liveness_latency = time.perf_counter() - start
+                    self.last_heartbeat = time.monotonic()
+                    self.missed_heartbeats = 0
+                    continue
+            except (exceptions.MessageTimeout, asyncio.TimeoutError, websocket.WebSocketException, OSError):
+                pass
+            self.missed_heartbeats += 1
+            self.logger.warning(f"OBS heartbeat missed ({self.missed_heartbeats}/{self.heartbeat_max_missed})")
+            if self.missed_heartbeats >= self.heartbeat_max_missed:
+                await self._mark_down()
+
+    async def _mark_down(self):
+        self.logger.warning("OBS is not responding, disconnecting")
+        self._condition_init()
+        try:
+            await asyncio.wait_for(asyncio.to_thread(self.ws.disconnect), timeout=5)
+        except (asyncio.TimeoutError, websocket.WebSocketException, OSError, AttributeError):
+            pass
+
+    def _fetch_stream_status(self):
+        changes = {}
+        res = self._call(requests.GetStreamStatus())
+        if res.status:
+            changes['streaming'] = res.getOutputActive()
+        res = self._call(requests.GetCurrentProgramScene())
+        if res.status:
+            changes['scene'] = res.getSceneName()
+        if changes:
+            self._set_state(**changes)
 
     async def _update_stream_status(self):
         try:
-            res = self.ws.call(requests.GetStreamStatus())
-            if res.status:
-                self.is_obs_streaming = res.getOutputActive()
-            res = self.ws.call(requests.GetCurrentProgramScene())
-            if res.status:
-                self.scene_name = res.getSceneName()
-        except exceptions.ConnectionFailure:
+            await asyncio.to_thread(self._fetch_stream_status)
+        except (exceptions.ConnectionFailure, exceptions.MessageTimeout, websocket.WebSocketException, OSError):
             self.logger.warning("Failed to check streaming status")
 
+    # イベントの取りこぼし対策、通常の更新はイベントで行う
     async def check_obs_streaming(self):
         while True:
+            await asyncio.sleep(self.sync_interval)
             if self.is_obs_running:
                 await self._update_stream_status()
-            await asyncio.sleep(2)
-
-    async def _attempt_reconnection(self):
-        try:
-            self.logger.info('Trying to reconnect to OBS...')
-            await asyncio.wait_for(
-                asyncio.to_thread(self.ws.reconnect),
-                timeout=5
-            )
-        except (exceptions.ConnectionFailure, asyncio.TimeoutError):
-            self.reset_conditions()
-
-    async def reconnection(self):
-        while True:
-            await asyncio.sleep(600)
-            if self.is_obs_running:
-                await self._attempt_reconnection()
 
     async def monitor(self):
         await asyncio.gather(
             self.check_obs_running(),
             self.check_obs_streaming(),
-            self.reconnection()
+            self.heartbeat()
         )
 
     def run(self):
@@ -98,7 +224,7 @@ def main():
     )
     monitor.run()
     while True:
-        print('loop...')
+        print(f'loop... running={monitor.is_obs_running} latency={monitor.liveness_latency_ms}ms')
         time.sleep(2)
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+MAX_USER_BUCKETS = 1000 # これを超えたら満杯に戻ったユーザーのバケットを捨てる
+NOTICE_DELAY_SEC = 5 # 制限した最初のコマンドからまとめて返信するまでの秒数
+
+class TokenBucket:
+    """
+    :param count: 続けて使える回数(バケットの容量)
+    :param period_sec: count回分が回復する秒数
+    """
+    def __init__(self, count: float, period_sec: float, now: float = None):
+        self.capacity = count
+        self.rate = count / period_sec
+        self.tokens = count
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def parse_limit(text: str):
+    """
+    :param text: '回数/秒'
+    :return: (回数, 秒)
+    """
+    count, period_sec = text.split('/')
+    return float(count), float(period_sec)
+
+
+class CommandRateLimiter:
+    """
+    チャットからのコマンドをユーザー毎・コマンド毎・全体のトークンバケットで制限する
+    全てのバケットに残りがある場合のみ、全てから1回分を使う
+    制限したコマンドは件数とユーザーを貯めておき、まとめて1回だけ返信する
+    :param user: ユーザー毎の(回数, 秒)
+    :param command: コマンド毎の(回数, 秒)
+    :param total: 全体の(回数, 秒)
+    """
+    def __init__(self, user=(2, 10), command=(5, 10), total=(10, 10)):
+        self.user_limit = user
+        self.command_limit = command
+        self.total = TokenBucket(*total)
+        self.users = {}
+        self.commands = {}
+        self.rejected = 0
+        self.rejected_users = []
+        self._lock = threading.Lock()
+
+    def _bucket(self, buckets, key, limit, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= MAX_USER_BUCKETS:
+                for idle in [k for k, b in buckets.items() if b.is_full(now)]:
+                    del buckets[idle]
+            bucket = buckets[key] = TokenBucket(*limit, now=now)
+        return bucket
+
+    def allow(self, user: str, command: str, privileged: bool = False, now: float = None):
+        """
+        :param privileged: 配信者等、ユーザー毎の制限のみ適用する(荒らしで全体の枠が尽きても操作できるように)
+        :return: 実行してよければTrue
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = [self._bucket(self.users, user, self.user_limit, now)]
+            if not privileged:
+                buckets.append(self._bucket(self.commands, command, self.command_limit, now))
+                buckets.append(self.total)
+            if not all(bucket.available(now) for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket.take()
+            return True
+
+    def reject(self, user: str):
+        """
+        制限したコマンドを記録する
+        :return: まとめた返信がまだ予定されていなければTrue、呼び出し側で後からflushして返信する
+        """
+        with self._lock:
+            self.rejected += 1
+            if user not in self.rejected_users:
+                self.rejected_users.append(user)
+            return self.rejected == 1
+
+    def flush(self):
+        """
+        :return: (制限した件数, ユーザー名のリスト)
+        """
+        with self._lock:
+            rejected, users = self.rejected, self.rejected_users
+            self.rejected = 0
+            self.rejected_users = []
+            return rejected, users
+
+
+def create_rate_limiter(config_ini, section: str):
+    return CommandRateLimiter(
+        user=parse_limit(config_ini.get(section, 'Rate_Limit_User', fallback='2/10')),
+        command=parse_limit(config_ini.get(section, 'Rate_Limit_Command', fallback='5/10')),
+        total=parse_limit(config_ini.get(section, 'Rate_Limit_Global', fallback='10/10'))
+    )
+
+def rejected_message(rejected: int, users):
+    shown = ', '.join(users[:5]) + (' 他' if len(users) > 5 else '')
+    return f'コマンドが多すぎるため{rejected}件を実行しませんでした({shown})'
@@ -1,64 +1,365 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import aiohttp
+import json
+import os
 import threading
-import xml.etree.ElementTree as ET
-from collections import deque
+import time
+from typing import NamedTuple
+from .bitrate_aggregator import BitrateAggregator
+from .bitrate_history import BitrateHistory
+from .broadcaster import Broadcaster
+from .logger import LoggerConfig
+from .rtmp_stat_parser import iter_stream_stats, parse_stream_stat
+from .trend_detector import TrendDetector
+
+# ビットレートの取得元
+BITRATE_SOURCE_NGINX = 'nginx' # nginxのbw_in、サーバー側で平滑化されている
+BITRATE_SOURCE_BYTES = 'bytes' # bytes_inの差分から算出、回線断の検知が速い
+
+MAX_OTHER_HISTORIES = 4 # 指定外のストリームの履歴を保持する数
+
+# 送信用にJSONへ変換済みのレスポンス
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+
+# 監視時点のストリーム毎の値
+class StreamSample(NamedTuple):
+    name: str
+    bw_in: float
+    avg_bw_in: float
+    stat: object  # StreamStat、statに無い場合はNone
+    windows: dict # BitrateAggregator.to_dict()
+    trend: object # TrendState
+
+# 監視毎に作り直す、作成後は変更しない
+# 他スレッドからはsnapshotを1回読めば値の組み合わせが揃っていることが保証される
+class BitrateSnapshot(NamedTuple):
+    version: int
+    timestamp: float  # statを受信した時刻(time.monotonic)
+    streams: dict     # ストリーム名 -> StreamSample
+    bitrate: dict     # ストリーム名 -> CachedResponse (/bitrate)
+    avg_bitrate: dict # (ストリーム名, 時間窓[sec]) -> CachedResponse (/avg_bitrate)
+    events: dict      # ストリーム名 -> SSEで送るJSONのbytes
+
+# ストリーム毎のビットレート
+class StreamState:
+    def __init__(self, name: str, average_bitrate_sec: float, windows_sec, interval_sec: float, source: str = BITRATE_SOURCE_NGINX,
+                 trend_window_sec: float = 4, trend_cusum_threshold: float = 8):
+        self.name = name
+        self.average_bitrate_sec = average_bitrate_sec
+        self.source = source
+        self.aggregator = BitrateAggregator(windows_sec, interval_sec)
+        self.trend = TrendDetector(trend_window_sec, interval_sec, cusum_threshold=trend_cusum_threshold)
+        self.bw_in = 0 #最新値
+        self.avg_bw_in = 0 #平均値(average_bitrate_sec)
+        self.stat = None #最新のStreamStat
+        self._last_bytes_in = None # (bytes_in, 取得時刻)
+
+    def update(self, stat, timestamp: float = None):
+        """
+        :param stat: StreamStat、statに無い場合はNone
+        :param timestamp: statを取得した時刻(time.monotonic)
+        """
+        self.stat = stat
+        if stat is not None and stat.nclients > 0:
+            bw_in = stat.bw_in
+            if self.source == BITRATE_SOURCE_BYTES:
+                derived = self._derive_bw_in(stat.bytes_in, time.monotonic() if timestamp is None else timestamp)
+                if derived is not None:
+                    bw_in = derived
+            self.bw_in = round(bw_in, 1)
+            self.aggregator.add(bw_in)
+            self.avg_bw_in = round(self.aggregator.mean(self.average_bitrate_sec), 1)
+            self.trend.add(bw_in)
+        else:
+            self.bw_in = 0
+            self._last_bytes_in = None
+            # 次の配信は新しい基準値から判定する
+            self.trend.reset()
+
+    def _derive_bw_in(self, bytes_in: int, timestamp: float):
+        # 前回取得時からの受信バイト数[bps]
+        # 再接続でカウンタが戻った場合や初回はNoneを返し、nginxのbw_inを使う
+        last = self._last_bytes_in
+        self._last_bytes_in = (bytes_in, timestamp)
+        if last is None:
+            return None
+        delta_bytes = bytes_in - last[0]
+        delta_sec = timestamp - last[1]
+        if delta_bytes < 0 or delta_sec <= 0:
+            return None
+        return delta_bytes * 8 / delta_sec
+
+    def window(self, window_sec: float = None):
+        """
+        :param window_sec: 時間窓[sec]、Noneの場合はaverage_bitrate_sec
+        :return: WindowStats、集計していない時間窓の場合はNone
+        """
+        return self.aggregator.window(window_sec or self.average_bitrate_sec)
 
 class RTMPMonitor:
-    def __init__(self, rtmp_stat_url: str, streamkey: str, monitoring_interval_sec: float = 0.5, average_bitrate_sec: float = 5):
+    def __init__(self, rtmp_stat_url: str, streamkey, monitoring_interval_sec: float = 0.5, average_bitrate_sec: float = 5,
+                 connect_timeout_sec: float = 1.0, read_timeout_sec: float = 2.0, windows_sec=(1, 5, 30, 300),
+                 bitrate_source: str = BITRATE_SOURCE_NGINX, trend_window_sec: float = 4, trend_cusum_threshold: float = 8,
+                 history_sec: float = 43200):
+        """
+        :param streamkey: 監視するストリームキー、リストの場合は先頭をメインのストリームとする
+                          指定外のストリームもstatに載っている間は監視する
+        :param windows_sec: 平均等を集計する時間窓[sec]、average_bitrate_secは必ず含める
+        :param bitrate_source: 'nginx'はnginxのbw_in、'bytes'はbytes_inの差分からビットレートを算出する
+        :param trend_window_sec: 低下の兆候を判定する傾きの時間窓[sec]
+        :param trend_cusum_threshold: 低下の兆候を判定するCUSUMの閾値、小さいほど早く反応し誤検知が増える
+        :param history_sec: ストリーム毎に履歴を保持する秒数、超えた分は古いものから上書きする
+                            指定外のストリームはMAX_OTHER_HISTORIES個まで、statから消えてhistory_sec経ったら捨てる
+        """
+        if bitrate_source not in (BITRATE_SOURCE_NGINX, BITRATE_SOURCE_BYTES):
+            raise ValueError(f"Unknown bitrate source: {bitrate_source}")
         self.rtmp_stat_url = rtmp_stat_url
-        self.streamkey = streamkey
+        self.streamkeys = [streamkey] if isinstance(streamkey, str) else list(streamkey)
+        self.streamkey = self.streamkeys[0]
         self.interval = monitoring_interval_sec
-        maxlen = int(round(average_bitrate_sec/monitoring_interval_sec))
-        self.bw_in_values = deque(maxlen=maxlen)
-        self.bw_in = 0 #最新値
-        self.avg_bw_in = 0 #平均値
+        self.average_bitrate_sec = average_bitrate_sec
+        self.windows_sec = sorted(set(windows_sec) | {average_bitrate_sec})
+        self.bitrate_source = bitrate_source
+        self.trend_window_sec = trend_window_sec
+        self.trend_cusum_threshold = trend_cusum_threshold
+        # ストリーム名 -> StreamState、更新時は辞書ごと差し替える
+        self.streams = {key: self._new_stream(key) for key in self.streamkeys}
+        # ストリーム名 -> BitrateHistory、配信が止まったストリームも残す、更新時は辞書ごと差し替える
+        self.history_sec = history_sec
+        self.history_capacity = max(1, int(history_sec / monitoring_interval_sec))
+        self.histories = {}
+        self.latency = None #直近のstat取得にかかった時間[sec]、失敗時も計測する
+        self.fetched_at = None #直近のstatを受信した時刻(time.monotonic)
+
+        # nginxが応答しないとループ全体が止まるため、接続・読み込みそれぞれにタイムアウトを設定する
+        self.timeout = aiohttp.ClientTimeout(
+            total=connect_timeout_sec + read_timeout_sec,
+            connect=connect_timeout_sec,
+            sock_read=read_timeout_sec
+        )
+        self.session = None
+        # 監視毎の値の配信、BitrateSnapshotを1回だけ作って全購読者・全リクエストで共有する
+        self.updates = Broadcaster()
+        self.snapshot = None
+        # 再起動を跨いでETagが一致しないようにする
+        self._etag_prefix = os.urandom(4).hex()
+        self.logger = LoggerConfig.get_logger(self.__class__.__name__)
+        self._loop = None
+        self._task = None
+        self._thread = None
+        self._publish()
+
+    # keep-aliveで使い回すセッション、イベントループ上で生成する必要があるため初回取得時に作る
+    async def open_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=1, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def close_session(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
 
     async def fetch_rtmp_stats(self):
-        async with aiohttp.ClientSession() as session:
+        session = await self.open_session()
+        start = time.perf_counter()
+        try:
             async with session.get(self.rtmp_stat_url) as response:
                 if response.status == 200:
-                    return await response.text()
+                    text = await response.text()
+                    self.fetched_at = time.monotonic()
+                    return text
                 else:
                     return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(f"Failed to fetch rtmp stat: {e!r}")
+            return None
+        finally:
+            self.latency = time.perf_counter() - start
 
-    def parse_bw_in(self, xml_data: str):
-        root = ET.fromstring(xml_data)
-        nclients = int(root.findtext("server/application[name='live']/live/nclients"))
-        if nclients == 0:
+    @property
+    def latency_ms(self):
+        if self.latency is None:
             return None
-        bw_in = int(root.findtext(f"server/application/[name='live']/live/stream[name='{self.streamkey}']/bw_in"))
-        return bw_in
+        return round(self.latency * 1000, 1)
+
+    # メインのストリームの値、直近のsnapshotから読む
+    @property
+    def bw_in(self):
+        return self.sample().bw_in
 
-    def calculate_average_bw_in(self):
-        if len(self.bw_in_values) == 0:
-            return 0
-        return sum(self.bw_in_values) / len(self.bw_in_values)
+    @property
+    def avg_bw_in(self):
+        return self.sample().avg_bw_in
+
+    @property
+    def stream_stat(self):
+        return self.sample().stat
+
+    def sample(self, name: str = None):
+        """
+        :param name: ストリーム名、Noneの場合はメインのストリーム
+        :return: 直近のsnapshotのStreamSample、statに無いストリームの場合はNone
+        """
+        return self.snapshot.streams.get(name or self.streamkey)
+
+    def _new_stream(self, name: str):
+        return StreamState(name, self.average_bitrate_sec, self.windows_sec, self.interval, self.bitrate_source,
+                           self.trend_window_sec, self.trend_cusum_threshold)
+
+    def get_stream(self, name: str = None):
+        """
+        監視ループが更新中の値のため、他スレッドからはsample()を使う
+        :param name: ストリーム名、Noneの場合はメインのストリーム
+        :return: StreamState、statに無いストリームの場合はNone
+        """
+        return self.streams.get(name or self.streamkey)
+
+    def get_history(self, name: str = None):
+        """
+        :param name: ストリーム名、Noneの場合はメインのストリーム
+        :return: BitrateHistory、記録の無いストリームの場合はNone
+        """
+        return self.histories.get(name or self.streamkey)
+
+    def _record_history(self, streams: dict):
+        now = time.time()
+        added = [name for name in streams if name not in self.histories]
+        # statから消えたストリームの履歴がある間は、古くなったものを捨てる
+        if added or len(self.histories) > len(streams):
+            self.histories = self._evict_histories(streams, added, now)
+        for name, state in streams.items():
+            history = self.histories.get(name)
+            if history is not None:
+                history.add(now, state.bw_in, state.avg_bw_in)
+
+    def _evict_histories(self, streams: dict, added, now: float):
+        """
+        テストの配信等、指定外のストリームの履歴でメモリが増え続けないよう数を抑える
+        :return: 新しいストリームの履歴を加えた辞書
+        """
+        histories = {
+            name: history for name, history in self.histories.items()
+            if name in self.streamkeys or name in streams or now - history.last_timestamp <= self.history_sec
+        }
+        for name in added:
+            if name not in self.streamkeys:
+                others = [other for other in histories if other not in self.streamkeys]
+                if len(others) >= MAX_OTHER_HISTORIES:
+                    # statから消えているもののうち、最も古いものと入れ替える
+                    gone = [other for other in others if other not in streams]
+                    if not gone:
+                        continue
+                    del histories[min(gone, key=lambda other: histories[other].last_timestamp)]
+            histories[name] = BitrateHistory(self.history_capacity)
+        return histories
+
+    def parse_stream_stat(self, xml_data: str):
+        return parse_stream_stat(xml_data, self.streamkey)
+
+    def parse_streams(self, xml_data: str):
+        return dict(iter_stream_stats(xml_data))
+
+    def update_streams(self, stats: dict, timestamp: float = None):
+        streams = {}
+        for name, stat in stats.items():
+            state = self.streams.get(name) or self._new_stream(name)
+            state.update(stat, timestamp)
+            streams[name] = state
+        # 指定されたストリームは配信が止まっても残す
+        for key in self.streamkeys:
+            if key not in streams:
+                state = self.streams[key]
+                state.update(None)
+                streams[key] = state
+        self.streams = streams
+        self._record_history(streams)
+        self._publish()
+
+    def _publish(self):
+        version = self.updates.version + 1
+        previous = self.snapshot
+        samples = {}
+        bitrate = {}
+        avg_bitrate = {}
+        events = {}
+        for name, state in self.streams.items():
+            samples[name] = StreamSample(name, state.bw_in, state.avg_bw_in, state.stat, state.aggregator.to_dict(), state.trend.state)
+            bitrate[name] = self._cached_response(
+                previous.bitrate.get(name) if previous else None,
+                {'bitrate': str(state.bw_in)},
+                version
+            )
+            for window_sec in self.windows_sec:
+                key = (name, window_sec)
+                avg_bitrate[key] = self._cached_response(
+                    previous.avg_bitrate.get(key) if previous else None,
+                    {'bitrate': str(round(state.window(window_sec).mean, 1))},
+                    version
+                )
+            events[name] = json.dumps({
+                'stream': name,
+                'bitrate': state.bw_in,
+                'avg_bitrate': state.avg_bw_in
+            }).encode()
+        # 参照の差し替えのみで公開する
+        timestamp = time.monotonic() if self.fetched_at is None else self.fetched_at
+        self.snapshot = BitrateSnapshot(version, timestamp, samples, bitrate, avg_bitrate, events)
+        self.updates.publish(self.snapshot)
+
+    def _cached_response(self, previous, data, version):
+        # 値が変わった時だけETagを進める、変わらなければ304を返せる
+        body = json.dumps(data, separators=(',', ':')).encode()
+        if previous is not None and previous.body == body:
+            return previous
+        return CachedResponse(body, f'"{self._etag_prefix}-{version}"')
+
+    def parse_bw_in(self, xml_data: str):
+        stat = self.parse_stream_stat(xml_data)
+        if stat is None or stat.nclients == 0:
+            return None
+        return stat.bw_in
 
     async def monitor(self):
-        while True:
-            xml_data = await self.fetch_rtmp_stats()
-            if xml_data:
-                self.parse_bw_in(xml_data)
-                bw_in = self.parse_bw_in(xml_data)
-                if bw_in is not None:
-                    self.bw_in = round(bw_in, 1)
-                    self.bw_in_values.append(bw_in)
-                    self.avg_bw_in = round(self.calculate_average_bw_in(), 1)
-                else:
-                    self.bw_in = 0
-            await asyncio.sleep(self.interval)
+        try:
+            while True:
+                xml_data = await self.fetch_rtmp_stats()
+                if xml_data:
+                    self.update_streams(self.parse_streams(xml_data), self.fetched_at)
+                await asyncio.sleep(self.interval)
+        finally:
+            await self.close_session()
 
     def run(self):
         def _run():
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
-            loop.run_until_complete(self.monitor())
+            self._loop = loop
+            self._task = loop.create_task(self.monitor())
+            try:
+                loop.run_until_complete(self._task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                loop.close()
+                self._loop = None
 
-        rtmp_monitoring_thread = threading.Thread(target=_run)
-        rtmp_monitoring_thread.daemon = True
-        rtmp_monitoring_thread.start()
+        self._thread = threading.Thread(target=_run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # 監視ループを止めてセッションを閉じる
+    def stop(self, timeout: float = 5):
+        if self._loop is not None and self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.logger.info("rtmp monitoring stopped")
 
 
 def main():
@@ -68,9 +369,12 @@ def main():
         streamkey='your_key'
     )
     rtmp_monitor.run()
-    while True:
-        print('loop...')
-        time.sleep(2)
+    try:
+        while True:
+            print(f'loop... bw_in={rtmp_monitor.bw_in} latency={rtmp_monitor.latency_ms}ms')
+            time.sleep(2)
+    except KeyboardInterrupt:
+        rtmp_monitor.stop()
 
 if __name__ == "__main__":
     main()
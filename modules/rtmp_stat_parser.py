@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import re
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from typing import NamedTuple
+
+# nginx-rtmpの/statから取り出すストリーム情報
+class StreamStat(NamedTuple):
+    nclients: int
+    bw_in: int
+    bytes_in: int
+    bw_video: int
+    bw_audio: int
+    fps: float
+
+_INT_FIELDS = ('nclients', 'bw_in', 'bytes_in', 'bw_video', 'bw_audio')
+
+def _to_int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return 0
+
+def _to_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _stream_stat(stream):
+    frame_rate = stream.find('meta/video/frame_rate')
+    return StreamStat(
+        *(_to_int(stream.findtext(field)) for field in _INT_FIELDS),
+        fps=_to_float(frame_rate.text if frame_rate is not None else None)
+    )
+
+def _find_application(xml_data: str, application: str):
+    """
+    対象のapplication要素を返す、無い場合はNone
+    statは他のapplicationのクライアント一覧等で大きくなるため、対象の<application>...</application>だけを
+    文字列検索で切り出してパースする。切り出せない場合は全体をパースする
+    """
+    name = escape(application)
+    match = re.search(r'<application>\s*<name>' + re.escape(name) + r'</name>', xml_data)
+    if match is not None:
+        end = xml_data.find('</application>', match.end())
+        if end != -1:
+            try:
+                return ET.fromstring(xml_data[match.start():end + len('</application>')])
+            except ET.ParseError:
+                pass
+    elif f'>{name}<' not in xml_data:
+        return None
+    # 想定と異なる書式の場合
+    root = ET.fromstring(xml_data)
+    for app in root.iterfind('server/application'):
+        if app.findtext('name') == application:
+            return app
+    return None
+
+def iter_stream_stats(xml_data: str, application: str = 'live'):
+    """
+    statのXMLから指定applicationのストリームを順に返す
+    :param xml_data: /statのXML文字列
+    :param application: 対象のapplication名
+    :return: (ストリーム名, StreamStat) のイテレータ
+    """
+    app = _find_application(xml_data, application)
+    if app is None:
+        return
+    for stream in app.iterfind('live/stream'):
+        name = stream.findtext('name')
+        if name is not None:
+            yield name, _stream_stat(stream)
+
+def parse_stream_stat(xml_data: str, streamkey: str, application: str = 'live'):
+    """
+    指定ストリームの情報を返す
+    :return: StreamStat、ストリームが無い場合はNone
+    """
+    for name, record in iter_stream_stats(xml_data, application):
+        if name == streamkey:
+            return record
+    return None
+
+
+# ベンチマーク
+# python -m modules.rtmp_stat_parser
+def _build_sample_stat(napps: int = 30, nstreams: int = 5, nclients: int = 20, streamkey: str = 'your_key', live_first: bool = True):
+    def client(i):
+        publishing = '<publishing/>' if i == 0 else ''
+        return (f'<client><id>{i}</id><address>10.0.0.{i % 250}</address><time>{i * 100}</time>'
+                f'<flashver>FMLE/3.0</flashver><dropped>0</dropped><avsync>-3</avsync>'
+                f'<timestamp>123456</timestamp>{publishing}<active/></client>')
+
+    def stream(name, bw_in):
+        clients = ''.join(client(i) for i in range(nclients))
+        return (f'<stream><name>{name}</name><time>1000</time><bw_in>{bw_in}</bw_in><bytes_in>123456789</bytes_in>'
+                f'<bw_out>0</bw_out><bytes_out>0</bytes_out><bw_audio>128000</bw_audio><bw_video>{bw_in - 128000}</bw_video>'
+                f'{clients}<meta><video><width>1920</width><height>1080</height><frame_rate>30</frame_rate>'
+                f'<codec>H264</codec></video><audio><codec>AAC</codec><channels>2</channels></audio></meta>'
+                f'<nclients>{nclients}</nclients><publishing/><active/></stream>')
+
+    def application(name, names):
+        streams = ''.join(stream(n, 3000000) for n in names)
+        return f'<application><name>{name}</name><live>{streams}<nclients>{nclients * len(names)}</nclients></live></application>'
+
+    live = application('live', [f'other{i}' for i in range(nstreams - 1)] + [streamkey])
+    others = ''.join(application(f'app{i}', [f'app{i}_{j}' for j in range(nstreams)]) for i in range(napps))
+    apps = live + others if live_first else others + live
+    return ('<?xml version="1.0" encoding="utf-8" ?><rtmp><nginx_version>1.24.0</nginx_version>'
+            '<uptime>100</uptime><naccepted>10</naccepted><bw_in>0</bw_in><bytes_in>0</bytes_in>'
+            f'<server>{apps}</server></rtmp>')
+
+def _parse_bw_in_dom(xml_data: str, streamkey: str):
+    # 旧実装(RTMPMonitor.parse_bw_in)と同じDOM + XPath
+    root = ET.fromstring(xml_data)
+    nclients = int(root.findtext("server/application[name='live']/live/nclients"))
+    if nclients == 0:
+        return None
+    return int(root.findtext(f"server/application/[name='live']/live/stream[name='{streamkey}']/bw_in"))
+
+def main():
+    import timeit
+    streamkey = 'your_key'
+    number = 100
+    for live_first in (True, False):
+        xml_data = _build_sample_stat(streamkey=streamkey, live_first=live_first)
+        assert parse_stream_stat(xml_data, streamkey).bw_in == _parse_bw_in_dom(xml_data, streamkey)
+
+        # 旧実装は1回の監視で2回パースしていた、1回にした場合とも比べる
+        dom2 = timeit.timeit(lambda: (_parse_bw_in_dom(xml_data, streamkey), _parse_bw_in_dom(xml_data, streamkey)), number=number)
+        dom1 = timeit.timeit(lambda: _parse_bw_in_dom(xml_data, streamkey), number=number)
+        # RTMPMonitor.parse_streamsと同じくapplication内の全ストリームを読む
+        sliced = timeit.timeit(lambda: dict(iter_stream_stats(xml_data)), number=number)
+        position = 'first' if live_first else 'last'
+        print(f'stat size: {len(xml_data) / 1024:.1f} KiB, application live is {position}')
+        print(f'  DOM x2      : {dom2 / number * 1000:.3f} ms/tick')
+        print(f'  DOM x1      : {dom1 / number * 1000:.3f} ms/tick')
+        print(f'  sliced parse: {sliced / number * 1000:.3f} ms/tick ({dom1 / sliced:.1f}x vs DOM x1)')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+SCENE_LIVE = 'live'
+SCENE_FAIL = 'fail'
+# 手動で切り替えるシーン、自動切替の対象外
+MANUAL_SCENES = ('intro', 'pause')
+
+class SceneSwitchPolicy:
+    """
+    ビットレートによるLive/Failの自動切替の判定、OBSには触れない
+    Failへは最新値か平均値がfail_bitrateを下回った時点で、Liveへは両方がrecover_bitrate以上で安定してから戻す
+    fail_bitrate〜recover_bitrateの間は現在のシーンを維持する(不感帯)
+    低下の兆候(degrading)を受け取った場合はfail_hold_secを待たずにFailにする
+    :param fail_bitrate: Failに切り替えるビットレート[bps]
+    :param recover_bitrate: Liveに戻すビットレート[bps]、Noneの場合はfail_bitrateと同じ
+    :param fail_hold_sec: fail_bitrateを下回った状態がこの秒数続いたらFailにする、0は即時
+    :param recover_hold_sec: recover_bitrate以上の状態がこの秒数続いたらLiveに戻す
+    :param min_dwell_sec: 自動切替の後、次の自動切替までの最短時間[sec]
+    """
+    def __init__(self, fail_bitrate: float, recover_bitrate: float = None, fail_hold_sec: float = 1,
+                 recover_hold_sec: float = 3, min_dwell_sec: float = 2):
+        self.fail_bitrate = fail_bitrate
+        self.recover_bitrate = fail_bitrate if recover_bitrate is None else max(recover_bitrate, fail_bitrate)
+        self.fail_hold_sec = fail_hold_sec
+        self.recover_hold_sec = recover_hold_sec
+        self.min_dwell_sec = min_dwell_sec
+        self.reset()
+
+    def reset(self):
+        self._low_since = None
+        self._high_since = None
+        self._last_switch = None
+
+    def decide(self, scene: str, bitrate: float, avg_bitrate: float, timestamp: float, degrading: bool = False):
+        """
+        サンプル毎に呼ぶ
+        :param scene: 現在のシーン('live'、'fail'等)、不明な場合はNone
+        :param timestamp: サンプルの時刻[sec]、単調増加
+        :param degrading: TrendDetectorによる低下の兆候、兆候がある間はLiveに戻さない
+        :return: 切り替えるシーン('live' or 'fail')、切り替えない場合はNone
+        """
+        if scene in MANUAL_SCENES:
+            self._low_since = None
+            self._high_since = None
+            return None
+
+        low = bitrate < self.fail_bitrate or avg_bitrate < self.fail_bitrate
+        high = bitrate >= self.recover_bitrate and avg_bitrate >= self.recover_bitrate and not degrading
+        if not low:
+            self._low_since = None
+        elif self._low_since is None:
+            self._low_since = timestamp
+        if not high:
+            self._high_since = None
+        elif self._high_since is None:
+            self._high_since = timestamp
+
+        if self._last_switch is not None and timestamp - self._last_switch < self.min_dwell_sec:
+            return None
+        if degrading and scene != SCENE_FAIL:
+            target = SCENE_FAIL
+        elif low and scene != SCENE_FAIL and timestamp - self._low_since >= self.fail_hold_sec:
+            target = SCENE_FAIL
+        elif high and scene != SCENE_LIVE and timestamp - self._high_since >= self.recover_hold_sec:
+            target = SCENE_LIVE
+        else:
+            return None
+        # 切替に失敗した場合もmin_dwell_secは再試行を待つ
+        self._last_switch = timestamp
+        return target
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+OBS・RTMP監視の状態を共有メモリに置き、ボットのプロセスからHTTPを介さずに読む
+書き込みはweb appの1プロセスのみ、seqlockで書き込み途中の値を読まないようにする
+"""
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import NamedTuple
+from .fixed_text import encode_fixed
+
+MAGIC = b'RTMPTEL1'
+# 書き込み回数、書き込み中は奇数
+_SEQ = struct.Struct('<Q')
+_SEQ_OFFSET = len(MAGIC)
+# 版番号, 更新時刻[UNIX時刻], bw_in, avg_bw_in, 低下の確度, フラグ, シーン名
+_PAYLOAD = struct.Struct('<QddddB7x32s')
+_PAYLOAD_OFFSET = _SEQ_OFFSET + _SEQ.size
+SIZE = _PAYLOAD_OFFSET + _PAYLOAD.size
+
+FLAG_RUNNING = 1
+FLAG_STREAMING = 2
+FLAG_RECEIVING = 4
+FLAG_DEGRADING = 8
+
+STALE_SEC = 10 # これより古い値は監視が止まっているものとする
+
+class Telemetry(NamedTuple):
+    version: int # /statusのversionと同じ値
+    updated: float
+    bw_in: float
+    avg_bw_in: float
+    trend_confidence: float
+    running: bool
+    streaming: bool
+    receiving: bool
+    degrading: bool
+    scene: str
+
+
+class TelemetryWriter:
+    """
+    共有メモリを作成して書き込む、nameをボットのプロセスに渡す
+    複数のスレッド(RTMP監視・OBSの受信)から書き込めるようロックで直列化する
+    """
+    def __init__(self):
+        self._shm = shared_memory.SharedMemory(create=True, size=SIZE)
+        self.name = self._shm.name
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._shm.buf[:SIZE] = bytes(SIZE)
+        self._shm.buf[:len(MAGIC)] = MAGIC
+
+    def write(self, version: int, bw_in: float, avg_bw_in: float, trend_confidence: float,
+              running: bool, streaming: bool, receiving: bool, degrading: bool, scene: str):
+        flags = (FLAG_RUNNING * running | FLAG_STREAMING * streaming
+                 | FLAG_RECEIVING * receiving | FLAG_DEGRADING * degrading)
+        with self._lock:
+            if self._shm is None:
+                return
+            buf = self._shm.buf
+            self._seq += 1
+            _SEQ.pack_into(buf, _SEQ_OFFSET, self._seq)
+            _PAYLOAD.pack_into(buf, _PAYLOAD_OFFSET, version, time.time(), bw_in, avg_bw_in,
+                               trend_confidence, flags, encode_fixed(scene or '', 32))
+            self._seq += 1
+            _SEQ.pack_into(buf, _SEQ_OFFSET, self._seq)
+
+    def close(self):
+        with self._lock:
+            if self._shm is None:
+                return
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+class TelemetryReader:
+    """
+    ボットのプロセスから読む、web appより先に起動しても読む時に接続し直す
+    :param name: TelemetryWriter.name
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._shm = None
+
+    def _attach(self):
+        if self._shm is None:
+            try:
+                # 読む側は終了時に共有メモリを消さないよう登録しない(Python 3.13以降)
+                self._shm = shared_memory.SharedMemory(name=self.name, track=False)
+            except TypeError:
+                self._shm = shared_memory.SharedMemory(name=self.name)
+            if bytes(self._shm.buf[:len(MAGIC)]) != MAGIC:
+                self.close()
+        return self._shm
+
+    def read(self, retries: int = 100):
+        """
+        :return: Telemetry、まだ書き込まれていない・読めない場合はNone
+        """
+        if not self.name:
+            return None
+        try:
+            shm = self._attach()
+        except FileNotFoundError:
+            return None
+        if shm is None:
+            return None
+        buf = shm.buf
+        for _ in range(retries):
+            seq = _SEQ.unpack_from(buf, _SEQ_OFFSET)[0]
+            if seq % 2:
+                time.sleep(0)
+                continue
+            payload = bytes(buf[_PAYLOAD_OFFSET:_PAYLOAD_OFFSET + _PAYLOAD.size])
+            # 読んでいる間に書き込まれていなければ確定
+            if _SEQ.unpack_from(buf, _SEQ_OFFSET)[0] != seq:
+                continue
+            if seq == 0:
+                return None
+            version, updated, bw_in, avg_bw_in, confidence, flags, scene = _PAYLOAD.unpack(payload)
+            return Telemetry(
+                version, updated, bw_in, avg_bw_in, confidence,
+                bool(flags & FLAG_RUNNING), bool(flags & FLAG_STREAMING),
+                bool(flags & FLAG_RECEIVING), bool(flags & FLAG_DEGRADING),
+                scene.rstrip(b'\0').decode(errors='replace')
+            )
+        return None
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+
+def status_message(telemetry):
+    """
+    ボットの?statusコマンドで返す文
+    """
+    if telemetry is None:
+        return 'ステータスを取得できません'
+    if not telemetry.running:
+        message = 'OBS未接続'
+    else:
+        message = ('配信中' if telemetry.streaming else '配信停止中') + f' / シーン: {telemetry.scene or "-"}'
+    if telemetry.receiving:
+        message += f' / {telemetry.bw_in / 1000:.0f} kbps (平均 {telemetry.avg_bw_in / 1000:.0f} kbps)'
+    else:
+        message += ' / 映像受信なし'
+    if telemetry.degrading:
+        message += ' / ビットレート低下中'
+    if time.time() - telemetry.updated > STALE_SEC:
+        message += ' (監視が停止しています)'
+    return message
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import math
+from collections import deque
+from typing import NamedTuple
+
+# 1サンプル毎の判定結果
+class TrendState(NamedTuple):
+    degrading: bool    # 低下の兆候あり
+    confidence: float  # 0〜1、1で確定
+    slope: float       # 直近の時間窓の傾き[bps/sec]
+    r2: float          # 傾きの当てはまり(決定係数)
+    cusum: float       # 下方向のCUSUM統計量
+    baseline: float    # CUSUMの基準値[bps]
+
+_STEADY = TrendState(False, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+class TrendDetector:
+    """
+    ビットレートの低下を落ち切る前に検知する、1サンプルあたり定数時間
+    - 直近window_secの最小二乗の傾きから、horizon_sec後の値が基準値のdrop_ratio以上下がる見込みなら低下
+    - 基準値からの下振れを累積するCUSUMがcusum_thresholdを超えたら低下、検知後は今の値を基準に取り直す
+    :param window_sec: 傾きを求める時間窓[sec]
+    :param interval_sec: サンプルの間隔[sec]
+    :param horizon_sec: 傾きから先読みする秒数
+    :param drop_ratio: 基準値に対する低下の割合、傾きによる判定に使う
+    :param cusum_threshold: CUSUMの閾値(標準偏差の何倍分の累積か)
+    :param cusum_slack: 1サンプル毎に許容する下振れ(標準偏差の何倍か)
+    :param baseline_sec: 基準値・ばらつきを追従させる時定数[sec]
+    :param min_r2: 傾きによる判定に必要な決定係数
+    :param slope_min_sigma: 傾きによる判定に必要な、推定値の基準値からの低下(標準偏差の何倍か)
+    :param warmup_sec: 開始・reset後に判定しない秒数、この間のサンプルの平均・分散を基準値・ばらつきの初期値にする
+    """
+    def __init__(self, window_sec: float = 4, interval_sec: float = 0.5, horizon_sec: float = 3,
+                 drop_ratio: float = 0.5, cusum_threshold: float = 8, cusum_slack: float = 1.0,
+                 baseline_sec: float = 30, min_r2: float = 0.6, slope_min_sigma: float = 3,
+                 warmup_sec: float = 10):
+        self.interval = interval_sec
+        self.size = max(3, int(round(window_sec / interval_sec)))
+        self.horizon = horizon_sec / interval_sec # サンプル数
+        self.drop_ratio = drop_ratio
+        self.cusum_threshold = cusum_threshold
+        self.cusum_slack = cusum_slack
+        self.alpha = 2 / (max(1, int(round(baseline_sec / interval_sec))) + 1)
+        self.min_r2 = min_r2
+        self.slope_min_sigma = slope_min_sigma
+        # 傾きの時間窓が埋まるまでは必ず待つ
+        self.warmup = max(self.size, int(round(warmup_sec / interval_sec)))
+        self.reset()
+
+    def reset(self):
+        self.values = deque()
+        # x = 0..n-1 (窓の先頭から) に対する合計
+        self._sum_y = 0.0
+        self._sum_xy = 0.0
+        self._sum_yy = 0.0
+        self._evicted = 0
+        self.baseline = None
+        self.variance = 0.0
+        self.cusum = 0.0
+        self.sigma = 0.0
+        self._warmup_count = 0
+        self._warmup_sum = 0.0
+        self._warmup_sum_sq = 0.0
+        self.state = _STEADY
+
+    def _add_value(self, y):
+        n = len(self.values)
+        if n < self.size:
+            self._sum_xy += n * y
+            self._sum_y += y
+        else:
+            old = self.values.popleft()
+            # 残りの値はxが1ずつ前にずれる
+            self._sum_y -= old
+            self._sum_xy += (n - 1) * y - self._sum_y
+            self._sum_y += y
+            self._sum_yy -= old * old
+            self._evicted += 1
+        self.values.append(y)
+        self._sum_yy += y * y
+        # floatの積み残し誤差を窓1周ごとに精算する
+        if self._evicted >= self.size:
+            self._evicted = 0
+            self._sum_y = sum(self.values)
+            self._sum_xy = sum(x * v for x, v in enumerate(self.values))
+            self._sum_yy = sum(v * v for v in self.values)
+
+    def _regression(self):
+        """
+        :return: (傾き[1サンプルあたり], 決定係数, 最新サンプル位置の推定値)
+        """
+        n = len(self.values)
+        sum_x = n * (n - 1) / 2
+        sum_xx = (n - 1) * n * (2 * n - 1) / 6
+        sxx = n * sum_xx - sum_x * sum_x
+        sxy = n * self._sum_xy - sum_x * self._sum_y
+        syy = n * self._sum_yy - self._sum_y * self._sum_y
+        slope = sxy / sxx
+        r2 = (sxy * sxy) / (sxx * syy) if syy > 0 else 0.0
+        fitted = (self._sum_y - slope * sum_x) / n + slope * (n - 1)
+        return slope, min(r2, 1.0), fitted
+
+    def add(self, value):
+        """
+        :return: TrendState
+        """
+        y = float(value)
+        self._add_value(y)
+        if self.baseline is None:
+            # 1サンプル目を基準値にすると、ばらつきが推定できるまで普段の揺れで反応するため
+            # warmup分を集めてから平均・分散で初期化する、それまでは判定しない
+            self._warmup_count += 1
+            self._warmup_sum += y
+            self._warmup_sum_sq += y * y
+            if self._warmup_count < self.warmup:
+                return self.state
+            n = self._warmup_count
+            self.baseline = self._warmup_sum / n
+            self.variance = max(0.0, (self._warmup_sum_sq - n * self.baseline * self.baseline) / (n - 1))
+            return self.state
+
+        # 基準値からの下振れを標準偏差で正規化して累積する
+        # 変動が極端に小さい配信でもわずかな揺れで反応しないよう、基準値の5%を下限とする
+        sigma = max(math.sqrt(self.variance), self.baseline * 0.05, 1.0)
+        self.sigma = sigma
+        self.cusum = max(0.0, self.cusum + (self.baseline - y) / sigma - self.cusum_slack)
+        cusum = self.cusum
+        cusum_alarm = cusum >= self.cusum_threshold
+        cusum_score = min(1.0, cusum / self.cusum_threshold)
+        if cusum_alarm:
+            # 下がった先の値を基準に取り直す、下がったまま安定すれば再び検知しない
+            self.baseline = y
+            self.cusum = 0.0
+        else:
+            diff = y - self.baseline
+            self.variance = (1 - self.alpha) * (self.variance + self.alpha * diff * diff)
+            # 下振れの累積中は基準値を動かさない
+            if self.cusum == 0.0:
+                self.baseline += self.alpha * diff
+
+        slope, r2, fitted = 0.0, 0.0, y
+        slope_alarm = False
+        slope_score = 0.0
+        if len(self.values) >= self.size:
+            slope, r2, fitted = self._regression()
+            reference = max(self.baseline, fitted, 1.0)
+            if slope < 0:
+                drop = -slope * self.horizon / reference
+                slope_score = r2 * min(1.0, drop / self.drop_ratio)
+                # ばらつきの大きい配信では揺れでも傾きが付くため、推定値が既にばらつき以上に下がっている場合のみ
+                slope_alarm = (drop >= self.drop_ratio and r2 >= self.min_r2
+                               and fitted <= self.baseline - self.slope_min_sigma * self.sigma)
+
+        self.state = TrendState(
+            degrading=cusum_alarm or slope_alarm,
+            confidence=round(max(cusum_score, slope_score), 3),
+            slope=round(slope / self.interval, 1),
+            r2=round(r2, 3),
+            cusum=round(cusum, 2),
+            baseline=round(self.baseline, 1)
+        )
+        return self.state
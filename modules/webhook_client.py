@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import socket
+import aiohttp
+from typing import NamedTuple
+from .logger import LoggerConfig
+
+RESULT_TIMEOUT = 'timeout' # web appの"result"と同じ値、応答待ちの上限を過ぎた(後から実行される場合がある)
+WAIT_MARGIN_SEC = 2 # web appが"timeout"を返してから届くまでの余裕[sec]
+
+class WebhookResponse(NamedTuple):
+    status_code: int # 接続できなかった・タイムアウトした場合は0
+    data: dict
+
+    @property
+    def timed_out(self):
+        return self.data.get('result') == RESULT_TIMEOUT
+
+    # requests.Responseと同じく呼び出し側でjson()を使えるようにする
+    def json(self):
+        return self.data
+
+class AsyncWebhookClient:
+    """
+    ボットからweb appのwebhookを呼ぶ、イベントループを止めない
+    keep-aliveの接続を使い回し、同時に送るリクエストの数を制限する
+    :param base_url: web appのURL(http://localhost:ポート)
+    :param webhook_path: webhookのパス
+    :param unix_socket: 指定した場合はUnixドメインソケットで接続する(server_mode = asyncのみ)
+    :param timeout_sec: 応答待ちの上限[sec]、接続待ちを含む、結果を待つ場合はweb appにこれより短い待ち時間を渡す
+    :param max_connections: 同時に送るリクエストの上限、超えた分は空くまで待つ
+    """
+    def __init__(self, base_url: str, webhook_path: str, unix_socket: str = None, timeout_sec: float = 15,
+                 connect_timeout_sec: float = 2, max_connections: int = 2):
+        self.base_url = base_url
+        self.url = base_url + webhook_path
+        self.unix_socket = unix_socket
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout_sec, connect=connect_timeout_sec)
+        self.wait_sec = max(1.0, timeout_sec - WAIT_MARGIN_SEC)
+        # Server-Sent Eventsは接続したまま読み続ける、keepaliveが途絶えたら切断する
+        self.stream_timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout_sec, sock_read=60)
+        self.session = None
+        self.logger = LoggerConfig.get_logger(self.__class__.__name__)
+
+    # イベントループ上で生成する必要があるため初回の送信時に作る
+    def _open_session(self):
+        if self.session is None or self.session.closed:
+            # subscribeで1本使い続けるため、その分を加える
+            limit = self.max_connections + 1
+            if self.unix_socket:
+                connector = aiohttp.UnixConnector(path=self.unix_socket, limit=limit)
+            else:
+                connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def post(self, data: dict, wait: bool = False):
+        """
+        :param wait: OBSの操作が終わるまで待つ、web appにはwait_secを渡しこちらより先に打ち切らせる
+        :return: WebhookResponse、失敗した場合もstatus_code=0で返す、待ちきれなかった場合はtimed_outがTrue
+        """
+        if wait:
+            data = {**data, 'wait': self.wait_sec}
+        session = self._open_session()
+        try:
+            async with session.post(self.url, json=data) as response:
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = {}
+                return WebhookResponse(response.status, body or {})
+        except asyncio.TimeoutError as e:
+            self.logger.warning(f"POST request timed out: {e!r}")
+            return WebhookResponse(0, {'result': RESULT_TIMEOUT})
+        except aiohttp.ClientError as e:
+            self.logger.warning(f"Failed to send POST request: {e!r}")
+            return WebhookResponse(0, {})
+
+    async def subscribe(self, path: str, callback, retry_sec: float = 3):
+        """
+        Server-Sent Eventsを購読し、イベント毎にawait callback(dict)を呼ぶ、切断されたら再接続し続ける
+        再接続時はLast-Event-IDを送り、切断中の通知から受け取る
+        :param path: /alerts/events等
+        """
+        last_id = None
+        while True:
+            session = self._open_session()
+            headers = {} if last_id is None else {'Last-Event-ID': last_id}
+            try:
+                async with session.get(self.base_url + path, headers=headers, timeout=self.stream_timeout) as response:
+                    response.raise_for_status()
+                    event_id, data = None, []
+                    async for line in response.content:
+                        line = line.decode(errors='replace').rstrip('\r\n')
+                        if line.startswith('id:'):
+                            event_id = line[3:].strip()
+                        elif line.startswith('data:'):
+                            data.append(line[5:].lstrip())
+                        elif not line and data:
+                            # 空行でイベントが確定する、retry:やコメント行は読み飛ばす
+                            if event_id is not None:
+                                last_id = event_id
+                            await self._dispatch(callback, '\n'.join(data))
+                            event_id, data = None, []
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.warning(f"Event stream {path} disconnected: {e!r}")
+            await asyncio.sleep(retry_sec)
+
+    async def _dispatch(self, callback, data):
+        # 受け取った側の不具合で購読を止めない
+        try:
+            await callback(json.loads(data))
+        except Exception as e:
+            self.logger.error(f"Event handler error: {e!r}")
+
+def create_webhook_client(config_ini):
+    """
+    ボット共通の設定からクライアントを作る
+    Unixドメインソケットはserver_mode = asyncで、OSが対応している場合のみ使う
+    """
+    unix_socket = config_ini.get('http', 'webhook_unix_socket', fallback='').strip()
+    if config_ini.get('http', 'server_mode', fallback='flask') != 'async' or not hasattr(socket, 'AF_UNIX'):
+        unix_socket = None
+    return AsyncWebhookClient(
+        'http://localhost:' + config_ini['http']['webhook_port'],
+        config_ini['http']['webhook_path'],
+        unix_socket=unix_socket or None,
+        timeout_sec=config_ini.getfloat('http', 'webhook_timeout', fallback=15),
+        max_connections=config_ini.getint('http', 'webhook_max_connections', fallback=2)
+    )
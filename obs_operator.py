@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import time
+from obswebsocket import requests
 from modules.obs_controler import OBSController
 from modules.obs_monitor import OBSMonitor
+from modules.scene_policy import SceneSwitchPolicy, SCENE_FAIL, SCENE_LIVE
 
 class OBSOperator(OBSController):
 
-    def __init__(self, config):
+    def __init__(self, config, start_monitor: bool = True):
         self.scene_dict = {
             'intro': config['obs']['Scene_Intro'],
             'live':  config['obs']['Scene_Live'],
@@ -13,6 +16,16 @@ class OBSOperator(OBSController):
         }
         self.fail_bw = int(config['obs']['RTMP_Fail_Bitrate'])
         self.stream_previous_scene = None
+        # 自動切替の閾値と保持時間、RTMP_Fail_Bitrate〜RTMP_Recover_Bitrateは不感帯
+        self.scene_policy = SceneSwitchPolicy(
+            fail_bitrate=self.fail_bw,
+            recover_bitrate=int(config['obs'].get('RTMP_Recover_Bitrate', self.fail_bw)),
+            fail_hold_sec=float(config['obs'].get('RTMP_Fail_Hold_Sec', 1)),
+            recover_hold_sec=float(config['obs'].get('RTMP_Recover_Hold_Sec', 3)),
+            min_dwell_sec=float(config['obs'].get('Scene_Min_Dwell_Sec', 2))
+        )
+        # ビットレートが落ち切る前に、低下の兆候でFailに切り替える
+        self.predictive_failover = config.getboolean('obs', 'Predictive_Failover', fallback=False)
 
         connection_settings = {
             'host': config['obs']['OBS_WS_host'],
@@ -21,8 +34,20 @@ class OBSOperator(OBSController):
         }
         
         super().__init__(**connection_settings)
-        self.obs_monitor = OBSMonitor(**connection_settings)
-        self.obs_monitor.run()
+        self.obs_monitor = OBSMonitor(
+            **connection_settings,
+            heartbeat_interval_sec=float(config['obs'].get('OBS_Heartbeat_Interval', 2)),
+            heartbeat_max_missed=int(config['obs'].get('OBS_Heartbeat_Missed', 3))
+        )
+        if start_monitor:
+            self.obs_monitor.run()
+
+    # OBSのシーン名からscene_dictのキー('intro'等)を引く、該当しない場合はNone
+    def _get_scene_id(self, scene_name):
+        for scene_id, name in self.scene_dict.items():
+            if name == scene_name:
+                return scene_id
+        return None
 
     # deco
     def obs_is_running(func):
@@ -43,13 +68,22 @@ class OBSOperator(OBSController):
         return _wrapper
 
     # 配信開始
+    # Intro画面への切替と配信開始を1往復で行う
     @obs_is_running
     def stream_start(self):
-        response = False
-        if self.stream_initialize():
-            if not self.obs_monitor.is_obs_streaming:
-                response = self.start_streaming()
-        return response
+        reqs = [requests.SetCurrentProgramScene(sceneName=self.scene_dict['intro'])]
+        if not self.obs_monitor.is_obs_streaming:
+            reqs.append(requests.StartStream())
+        # Introが無い等でシーンの切替に失敗しても配信は開始する(切替の失敗は個別に記録する)
+        response = self.call_batch(*reqs, halt_on_failure=False)
+        if response is False:
+            return False
+        if not response[0].status:
+            self.logger.warning(f"Failed to set scene {self.scene_dict['intro']} before starting the stream")
+        self.stream_previous_scene = None
+        if len(response) < 2:
+            return False
+        return response[-1]
 
     # 配信終了
     @obs_is_running
@@ -156,22 +190,31 @@ class OBSOperator(OBSController):
 
 
     # auto scene swich by bw_in
-    def scene_switch_by_bitrate(self, bitrate: int, avg_bitrate: int):
+    # RTMPの監視毎に呼ばれる、判定はscene_policyで行う
+    def scene_switch_by_bitrate(self, bitrate: int, avg_bitrate: int, timestamp: float = None, trend=None):
+        """
+        :param trend: RTMPMonitorのTrendState、Predictive_Failoverが有効な場合に使う
+        """
         response = False
-        scene = self._get_scene_id(self.obs_monitor.scene_name)
-        if scene in ['intro', 'pause']:
-            print('switch skipped')
+        # 判定中に切断等で値が変わっても、同じ時点の状態で判断する
+        state = self.obs_monitor.state
+        if not (state.running and state.streaming):
+            self.scene_policy.reset()
             return response
-
-        # live -> fail
-        if avg_bitrate < self.fail_bw: # or bitrate <= 0 :
+        scene = self._get_scene_id(state.scene)
+        degrading = self.predictive_failover and trend is not None and trend.degrading
+        target = self.scene_policy.decide(
+            scene, bitrate, avg_bitrate,
+            time.monotonic() if timestamp is None else timestamp,
+            degrading
+        )
+        if target == SCENE_FAIL:
+            if degrading:
+                self.logger.info(f"Switch to fail (degrading): bitrate={bitrate} confidence={trend.confidence} slope={trend.slope}")
+            else:
+                self.logger.info(f"Switch to fail: bitrate={bitrate} avg_bitrate={avg_bitrate}")
             response = self.scene_set_fail()
-
-        # live -> live
-        elif scene in ['live']:
-            return response
-
-        # fail, low -> live
-        else:
+        elif target == SCENE_LIVE:
+            self.logger.info(f"Switch to live: bitrate={bitrate} avg_bitrate={avg_bitrate}")
             response = self.scene_set_live()
         return response
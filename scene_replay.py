@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+記録したビットレートを自動切替の判定に流し、閾値・時間窓の組み合わせを比較する
+OBSには接続せず、判定はOBSOperator.scene_switch_by_bitrateをそのまま使う
+
+python scene_replay.py trace.csv --fail 300,500,800 --average 3,5,10 --interval 0.5,1
+python scene_replay.py logs/rtmp-20240101-120000.bin --fail 500
+CSVはヘッダ付きで time[sec],bitrate[bps] の列が必須、nclientsは任意
+bitrateが空の行はstatにストリームが無かったものとして扱う
+.binはbinary_log_dirに記録したファイル、--streamで対象のストリームを指定する
+"""
+import argparse
+import csv
+import itertools
+import logging
+import time
+from typing import NamedTuple
+from obs_operator import OBSOperator
+from modules.binary_log import BinaryLogReader
+from modules.obs_monitor import OBSState
+from modules.rtmp_monitor import StreamState
+from modules.rtmp_stat_parser import StreamStat
+from modules.scene_policy import SceneSwitchPolicy, SCENE_FAIL
+
+SCENE_DICT = {'intro': 'Intro', 'live': 'Live', 'fail': 'Fail', 'pause': 'Pause'}
+
+class Outage(NamedTuple):
+    start: float
+    end: float
+
+class ReplayResult(NamedTuple):
+    fail_bitrate: float
+    recover_bitrate: float
+    average_sec: float
+    interval: float
+    switches: int       # 切替の回数
+    false_fails: int    # 障害が無いのにFailにした回数
+    missed_sec: float   # 障害が始まってからFailになるまでの合計[sec]
+    max_missed_sec: float
+
+def load_csv(path: str):
+    """
+    :return: [(時刻[sec], StreamStat or None)]、時刻順
+    """
+    samples = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            bitrate = row.get('bitrate', row.get('bw_in'))
+            stat = None
+            if bitrate not in (None, ''):
+                bw_in = int(float(bitrate))
+                nclients = int(row['nclients']) if row.get('nclients') else 1
+                stat = StreamStat(nclients=nclients, bw_in=bw_in, bytes_in=0, bw_video=0, bw_audio=0, fps=0.0)
+            samples.append((float(row['time']), stat))
+    samples.sort(key=lambda sample: sample[0])
+    return samples
+
+def load_binary_log(path: str, stream_name: str = None):
+    """
+    :param stream_name: ストリーム名、Noneの場合は先頭のストリーム
+    :return: [(時刻[sec], StreamStat or None)]、時刻は記録開始からの秒数
+    """
+    with BinaryLogReader(path) as reader:
+        return [
+            (timestamp - reader.created,
+             StreamStat(nclients=1, bw_in=int(bw_in), bytes_in=0, bw_video=0, bw_audio=0, fps=0.0) if active else None)
+            for timestamp, bw_in, _, active in reader.samples(stream_name)
+        ]
+
+def _bitrate(stat):
+    return stat.bw_in if stat is not None and stat.nclients > 0 else 0
+
+def find_outages(samples, outage_bitrate: float, min_sec: float):
+    """
+    記録の全サンプルから正解の障害区間を求める
+    :param outage_bitrate: このビットレート未満を障害とする[bps]
+    :param min_sec: これより短い低下は障害としない
+    """
+    outages = []
+    start = None
+    for timestamp, stat in samples:
+        if _bitrate(stat) < outage_bitrate:
+            if start is None:
+                start = timestamp
+        elif start is not None:
+            if timestamp - start >= min_sec:
+                outages.append(Outage(start, timestamp))
+            start = None
+    if start is not None and samples and samples[-1][0] - start >= min_sec:
+        outages.append(Outage(start, samples[-1][0]))
+    return outages
+
+def resample(samples, interval: float):
+    """
+    監視間隔をintervalにした場合に取得するサンプルを選ぶ
+    """
+    selected = []
+    next_time = None
+    for timestamp, stat in samples:
+        if next_time is None or timestamp >= next_time - 1e-6:
+            selected.append((timestamp, stat))
+            next_time = timestamp + interval
+    return selected
+
+
+class ReplayOperator:
+    """
+    OBSOperatorの自動切替の判定をそのまま使い、シーンの切替は記録するだけのOBS
+    """
+    scene_switch_by_bitrate = OBSOperator.scene_switch_by_bitrate
+    _get_scene_id = OBSOperator._get_scene_id
+
+    def __init__(self, policy: SceneSwitchPolicy, predictive_failover: bool = False):
+        self.scene_dict = SCENE_DICT
+        self.scene_policy = policy
+        self.predictive_failover = predictive_failover
+        self.logger = logging.getLogger(self.__class__.__name__) # 切替毎のログは出さない
+        self.obs_monitor = self # obs_monitor.stateを参照するため
+        self.state = OBSState(0, True, True, SCENE_DICT['live'])
+        self.switches = [] # (時刻, 'live' or 'fail')
+        self._now = None
+
+    def _set_scene(self, scene_id):
+        self.state = self.state._replace(version=self.state.version + 1, scene=self.scene_dict[scene_id])
+        self.switches.append((self._now, scene_id))
+        return True
+
+    def scene_set_fail(self):
+        return self._set_scene('fail')
+
+    def scene_set_live(self):
+        return self._set_scene('live')
+
+    def feed(self, timestamp, bitrate, avg_bitrate, trend):
+        self._now = timestamp
+        self.scene_switch_by_bitrate(bitrate, avg_bitrate, timestamp, trend)
+
+def score(operator: ReplayOperator, outages, lookahead_sec: float):
+    """
+    :param lookahead_sec: Failにしてからこの秒数以内に障害が始まれば正しい切替とする(先読み分)
+    :return: (切替回数, 誤ったFailの回数, 見逃した合計秒数, 見逃した最大秒数)
+    """
+    fails = [timestamp for timestamp, scene_id in operator.switches if scene_id == SCENE_FAIL]
+    false_fails = 0
+    for timestamp in fails:
+        if not any(outage.start - lookahead_sec <= timestamp <= outage.end for outage in outages):
+            false_fails += 1
+    missed = []
+    for outage in outages:
+        detected = next((timestamp for timestamp in fails if outage.start - lookahead_sec <= timestamp <= outage.end), None)
+        # 障害が始まる前に切り替えていれば0
+        missed.append(outage.end - outage.start if detected is None else max(0.0, detected - outage.start))
+    return len(operator.switches), false_fails, sum(missed), max(missed, default=0.0)
+
+def sweep(samples, fail_bitrates, average_secs, intervals, recover_bitrates=(None,), outage_bitrate: float = None,
+          outage_min_sec: float = 2, lookahead_sec: float = 5, predictive_failover: bool = False,
+          trend_window_sec: float = 4, trend_cusum_threshold: float = 8, **policy_kwargs):
+    """
+    監視間隔毎に記録を1回だけ走査し、全ての閾値・時間窓の組み合わせを同時に判定する
+    平均値は時間窓毎に1回だけ計算して、同じ時間窓の組み合わせで共有する
+    :param outage_bitrate: 正解の障害とするビットレート、Noneの場合はfail_bitratesの最小値
+    :param policy_kwargs: SceneSwitchPolicyのfail_hold_sec等
+    :return: [ReplayResult]
+    """
+    if outage_bitrate is None:
+        outage_bitrate = min(fail_bitrates)
+    outages = find_outages(samples, outage_bitrate, outage_min_sec)
+    results = []
+    for interval in intervals:
+        state = StreamState('replay', average_secs[0], average_secs, interval,
+                            trend_window_sec=trend_window_sec, trend_cusum_threshold=trend_cusum_threshold)
+        settings = list(itertools.product(fail_bitrates, recover_bitrates, average_secs))
+        operators = [
+            ReplayOperator(SceneSwitchPolicy(fail, recover, **policy_kwargs), predictive_failover)
+            for fail, recover, _ in settings
+        ]
+        for timestamp, stat in resample(samples, interval):
+            state.update(stat, timestamp)
+            means = {sec: round(window.mean, 1) for sec, window in state.aggregator.windows.items()}
+            trend = state.trend.state
+            for (_, _, average_sec), operator in zip(settings, operators):
+                operator.feed(timestamp, state.bw_in, means[float(average_sec)], trend)
+        for (fail, recover, average_sec), operator in zip(settings, operators):
+            results.append(ReplayResult(
+                fail, operator.scene_policy.recover_bitrate, average_sec, interval,
+                *score(operator, outages, lookahead_sec)
+            ))
+    return results, outages
+
+def _floats(text):
+    return [float(value) for value in text.split(',') if value.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description='自動切替の閾値・時間窓を記録したビットレートで比較する')
+    parser.add_argument('trace', help='記録したビットレート(CSV、またはbinary_log_dirの.bin)')
+    parser.add_argument('--stream', default=None, help='.binの対象のストリーム名、省略時は先頭のストリーム')
+    parser.add_argument('--fail', type=_floats, default=[500], help='RTMP_Fail_Bitrateの候補[bps]、カンマ区切り')
+    parser.add_argument('--recover', type=_floats, default=None, help='RTMP_Recover_Bitrateの候補[bps]、省略時はFailと同じ')
+    parser.add_argument('--average', type=_floats, default=[5], help='average_bitrate_secの候補、カンマ区切り')
+    parser.add_argument('--interval', type=_floats, default=[0.5], help='監視間隔[sec]の候補、記録の間隔以上')
+    parser.add_argument('--fail-hold', type=float, default=1, help='RTMP_Fail_Hold_Sec')
+    parser.add_argument('--recover-hold', type=float, default=3, help='RTMP_Recover_Hold_Sec')
+    parser.add_argument('--dwell', type=float, default=2, help='Scene_Min_Dwell_Sec')
+    parser.add_argument('--predictive', action='store_true', help='Predictive_Failoverを有効にする')
+    parser.add_argument('--outage-bitrate', type=float, default=None, help='障害とするビットレート[bps]、省略時は--failの最小値')
+    parser.add_argument('--outage-min-sec', type=float, default=2, help='障害とする最短の秒数')
+    parser.add_argument('--lookahead', type=float, default=5, help='障害の何秒前までのFailを正しい切替とするか')
+    parser.add_argument('--top', type=int, default=20, help='表示する件数')
+    args = parser.parse_args()
+
+    if args.trace.endswith('.bin'):
+        samples = load_binary_log(args.trace, args.stream)
+    else:
+        samples = load_csv(args.trace)
+    start = time.perf_counter()
+    results, outages = sweep(
+        samples, args.fail, args.average, args.interval,
+        recover_bitrates=args.recover or [None],
+        outage_bitrate=args.outage_bitrate,
+        outage_min_sec=args.outage_min_sec,
+        lookahead_sec=args.lookahead,
+        predictive_failover=args.predictive,
+        fail_hold_sec=args.fail_hold,
+        recover_hold_sec=args.recover_hold,
+        min_dwell_sec=args.dwell
+    )
+    elapsed = time.perf_counter() - start
+    duration = samples[-1][0] - samples[0][0] if samples else 0
+    print(f'{len(samples)} samples ({duration:.0f} sec), {len(outages)} outages, '
+          f'{len(results)} settings in {elapsed:.2f} sec ({duration / max(elapsed, 1e-9):.0f}x real time)')
+
+    results.sort(key=lambda r: (r.false_fails, r.missed_sec, r.switches))
+    print(f'{"fail":>8} {"recover":>8} {"avg":>5} {"intvl":>5} {"switch":>6} {"false":>5} {"missed":>8} {"max":>6}')
+    for r in results[:args.top]:
+        print(f'{r.fail_bitrate:8g} {r.recover_bitrate:8g} {r.average_sec:5g} {r.interval:5g} '
+              f'{r.switches:6d} {r.false_fails:5d} {r.missed_sec:8.1f} {r.max_missed_sec:6.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+from modules.binary_log import BinaryLogWriter, BinaryLogReader, session_path, KIND_SCENE, KIND_OBS
+
+def test_scene_names_are_not_cut(tmp_path):
+    path = str(tmp_path / 'log.bin')
+    writer = BinaryLogWriter(path, ['your_key'])
+    scenes = ['配信中のシーンです', 'Intro', '配信中のシーンです']
+    for i, scene in enumerate(scenes):
+        writer.write_event(KIND_SCENE, text=scene, timestamp=100 + i)
+    writer.write_event(KIND_OBS, 1, timestamp=110)
+    # 記録中のファイルも読める
+    with BinaryLogReader(path) as reader:
+        assert [record.text for record in reader.records(kinds=(KIND_SCENE,))] == scenes
+    writer.close()
+    with BinaryLogReader(path) as reader:
+        assert reader.scenes == ['配信中のシーンです', 'Intro']
+        assert [record.text for record in reader.records(kinds=(KIND_SCENE,))] == scenes
+
+def test_long_stream_name_is_cut_on_character_boundary(tmp_path):
+    path = str(tmp_path / 'log.bin')
+    name = 'ストリーム' * 4 # 60byte
+    writer = BinaryLogWriter(path, [name])
+    writer.write_sample(name, 1000, 900, timestamp=100)
+    writer.close()
+    with BinaryLogReader(path) as reader:
+        assert reader.streams == ['ストリーム' * 2]
+        assert reader.samples(name) == [(100, 1000, 900, True)]
+
+def test_session_path_is_unique_within_a_second(tmp_path):
+    paths = [session_path(str(tmp_path), keep=10) for _ in range(3)]
+    assert len(set(paths)) == 3
+    assert all(os.path.exists(path) for path in paths)
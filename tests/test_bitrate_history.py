@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from modules.bitrate_history import BitrateHistory
+from modules.rtmp_monitor import RTMPMonitor, MAX_OTHER_HISTORIES
+
+def test_history_grows_lazily_and_wraps():
+    history = BitrateHistory(4)
+    assert len(history.timestamps) == 0
+    for i in range(3):
+        history.add(i, i * 10, i * 5)
+    assert len(history.timestamps) == 3
+    assert list(history.range()[0]) == [0, 1, 2]
+    for i in range(3, 7):
+        history.add(i, i * 10, i * 5)
+    assert len(history.timestamps) == 4
+    timestamps, bitrates, _ = history.range(4)
+    assert (list(timestamps), list(bitrates)) == ([4, 5, 6], [40, 50, 60])
+    assert history.last_timestamp == 6
+
+def make_monitor(history_sec=60):
+    return RTMPMonitor('http://127.0.0.1/stat', 'your_key', history_sec=history_sec)
+
+def test_histories_of_other_streams_are_capped():
+    monitor = make_monitor()
+    for i in range(MAX_OTHER_HISTORIES + 5):
+        # テストの配信が入れ替わりに現れる
+        monitor.update_streams({f'test{i}': None})
+    assert 'your_key' in monitor.histories
+    assert len(monitor.histories) == 1 + MAX_OTHER_HISTORIES
+    assert f'test{MAX_OTHER_HISTORIES + 4}' in monitor.histories
+
+def test_histories_of_gone_streams_are_dropped(monkeypatch):
+    monitor = make_monitor(history_sec=60)
+    now = [1000.0]
+    monkeypatch.setattr('modules.rtmp_monitor.time.time', lambda: now[0])
+    monitor.update_streams({'test': None})
+    now[0] += 30
+    monitor.update_streams({})
+    assert 'test' in monitor.histories
+    now[0] += 61
+    monitor.update_streams({})
+    assert set(monitor.histories) == {'your_key'}
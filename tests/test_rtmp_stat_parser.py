@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import pytest
+from modules.rtmp_stat_parser import iter_stream_stats, parse_stream_stat, _build_sample_stat
+
+@pytest.mark.parametrize('live_first', [True, False])
+def test_reads_live_application_wherever_it_is(live_first):
+    xml_data = _build_sample_stat(napps=3, nclients=2, live_first=live_first)
+    streams = dict(iter_stream_stats(xml_data))
+    assert sorted(streams) == ['other0', 'other1', 'other2', 'other3', 'your_key']
+    stat = streams['your_key']
+    assert (stat.nclients, stat.bw_in, stat.bw_audio, stat.fps) == (2, 3000000, 128000, 30.0)
+
+def test_same_result_for_pretty_printed_and_unexpected_layout():
+    xml_data = _build_sample_stat(napps=3, nclients=2, live_first=False)
+    expected = dict(iter_stream_stats(xml_data))
+    assert dict(iter_stream_stats(xml_data.replace('><', '>\r\n<'))) == expected
+    # 切り出せない書式は全体のパースで読む
+    odd = xml_data.replace('<application><name>live</name>', '<application ><name>live</name>')
+    assert dict(iter_stream_stats(odd)) == expected
+
+def test_missing_application_or_stream():
+    xml_data = _build_sample_stat(napps=3, nclients=2)
+    assert list(iter_stream_stats(xml_data, 'nope')) == []
+    assert parse_stream_stat(xml_data, 'missing') is None
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+from modules.broadcaster import Broadcaster
+from modules.obs_command_queue import OBSCommandQueue, COMMAND_SUPERSEDED, COMMAND_EXPIRED
+from modules.rtmp_monitor import BitrateSnapshot, StreamSample
+from modules.scene_policy import SceneSwitchPolicy, SCENE_FAIL
+from modules.trend_detector import TrendState
+from scene_replay import ReplayOperator
+from web_app import WebApp
+
+def make_app():
+    app = WebApp.__new__(WebApp)
+    app.rtmp_monitor = SimpleNamespace(streamkey='your_key', updates=Broadcaster())
+    app.obs_operator = ReplayOperator(SceneSwitchPolicy(500, 1000), predictive_failover=True)
+    # startするまで実行しない、OBSの応答待ちの間に判定が積まれた状態にする
+    app.obs_commands = OBSCommandQueue()
+    app._start_scene_control()
+    return app
+
+def snapshot(version, timestamp, degrading):
+    trend = TrendState(degrading, 1.0 if degrading else 0.0, 0.0, 0.0, 0.0, 3000000.0)
+    sample = StreamSample('your_key', 3000000, 3000000, None, {}, trend)
+    return BitrateSnapshot(version, timestamp, {'your_key': sample}, {}, {}, {})
+
+def test_degrading_of_superseded_sample_still_switches_to_fail():
+    app = make_app()
+    alarm = app._submit_scene_control(1, snapshot(1, 10.0, True))
+    # 検知後は基準値を取り直すため、次のサンプルには兆候が出ない
+    latest = app._submit_scene_control(2, snapshot(2, 10.5, False))
+    app.obs_commands.start()
+    try:
+        assert alarm.result(timeout=5).status == COMMAND_SUPERSEDED
+        assert latest.result(timeout=5).status not in (COMMAND_SUPERSEDED, COMMAND_EXPIRED)
+    finally:
+        app.obs_commands.stop(timeout=5)
+    assert [scene_id for _, scene_id in app.obs_operator.switches] == [SCENE_FAIL]
+
+def test_degrading_is_used_only_once():
+    app = make_app()
+    app.obs_commands.start()
+    try:
+        app._submit_scene_control(1, snapshot(1, 10.0, True)).result(timeout=5)
+        app.obs_operator.scene_policy.min_dwell_sec = 0
+        app.obs_operator.state = app.obs_operator.state._replace(scene='Live')
+        app._submit_scene_control(2, snapshot(2, 10.5, False)).result(timeout=5)
+    finally:
+        app.obs_commands.stop(timeout=5)
+    assert [scene_id for _, scene_id in app.obs_operator.switches] == [SCENE_FAIL]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from modules.scene_policy import SceneSwitchPolicy, SCENE_LIVE, SCENE_FAIL
+
+def make_policy(**kwargs):
+    params = dict(fail_bitrate=500, recover_bitrate=1000, fail_hold_sec=1, recover_hold_sec=3, min_dwell_sec=2)
+    params.update(kwargs)
+    return SceneSwitchPolicy(**params)
+
+def feed(policy, scene, samples, start=0.0, interval=0.5):
+    """
+    :param samples: [(bitrate, avg_bitrate)]
+    :return: [(時刻, 切り替えたシーン)]、切り替えた結果を次のサンプルのsceneにする
+    """
+    switches = []
+    for i, (bitrate, avg_bitrate) in enumerate(samples):
+        timestamp = start + i * interval
+        target = policy.decide(scene, bitrate, avg_bitrate, timestamp)
+        if target is not None:
+            switches.append((timestamp, target))
+            scene = target
+    return switches
+
+def test_single_dip_does_not_switch():
+    policy = make_policy()
+    assert feed(policy, SCENE_LIVE, [(3000, 3000)] * 4 + [(0, 2500)] + [(3000, 3000)] * 10) == []
+
+def test_fail_after_hold():
+    policy = make_policy()
+    assert feed(policy, SCENE_LIVE, [(3000, 3000)] * 4 + [(0, 2000)] * 6) == [(3.0, SCENE_FAIL)]
+
+def test_zero_hold_switches_at_once():
+    policy = make_policy(fail_hold_sec=0)
+    assert feed(policy, SCENE_LIVE, [(3000, 3000)] * 4 + [(0, 2000)]) == [(2.0, SCENE_FAIL)]
+
+def test_dead_band_keeps_current_scene():
+    for scene in (SCENE_LIVE, SCENE_FAIL):
+        policy = make_policy()
+        assert feed(policy, scene, [(700, 700)] * 40) == []
+
+def test_recover_after_hold():
+    policy = make_policy()
+    assert feed(policy, SCENE_FAIL, [(0, 0)] * 2 + [(1500, 1500)] * 10) == [(4.0, SCENE_LIVE)]
+
+def test_recover_hold_restarts_on_dip():
+    policy = make_policy()
+    samples = [(1500, 1500)] * 4 + [(900, 1200)] + [(1500, 1500)] * 10
+    assert feed(policy, SCENE_FAIL, samples) == [(5.5, SCENE_LIVE)]
+
+def test_min_dwell_between_switches():
+    policy = make_policy(fail_hold_sec=0, recover_hold_sec=0, min_dwell_sec=2)
+    samples = [(0, 0), (1500, 1500), (1500, 1500), (1500, 1500), (1500, 1500), (1500, 1500)]
+    assert feed(policy, SCENE_LIVE, samples) == [(0.0, SCENE_FAIL), (2.0, SCENE_LIVE)]
+
+def test_degrading_skips_fail_hold_and_blocks_recover():
+    policy = make_policy()
+    assert policy.decide(SCENE_LIVE, 3000, 3000, 0.0, degrading=True) == SCENE_FAIL
+    assert policy.decide(SCENE_FAIL, 3000, 3000, 10.0, degrading=True) is None
+    assert policy.decide(SCENE_FAIL, 3000, 3000, 10.5) is None
+    assert policy.decide(SCENE_FAIL, 3000, 3000, 13.5) == SCENE_LIVE
+
+def test_manual_scenes_are_left_alone():
+    policy = make_policy()
+    assert feed(policy, 'pause', [(0, 0)] * 10) == []
+    assert feed(policy, 'intro', [(0, 0)] * 10) == []
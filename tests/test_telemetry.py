@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from modules.telemetry import TelemetryWriter, TelemetryReader
+
+def test_long_scene_name_is_cut_on_character_boundary():
+    writer = TelemetryWriter()
+    reader = TelemetryReader(writer.name)
+    try:
+        # 3byteの文字が32byteの境界をまたぐ
+        writer.write(1, 3000000, 2900000, 0.0, True, True, True, False, 'あ' * 11)
+        telemetry = reader.read()
+        assert telemetry.scene == 'あ' * 10
+        assert (telemetry.version, telemetry.streaming, telemetry.degrading) == (1, True, False)
+    finally:
+        reader.close()
+        writer.close()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import random
+import pytest
+from modules.trend_detector import TrendDetector
+
+BITRATE = 3000000
+
+def _noisy(rng, noise):
+    return BITRATE * (1 + rng.gauss(0, noise))
+
+@pytest.mark.parametrize('noise', [0.05, 0.1, 0.2])
+def test_no_alarm_after_reset_on_flat_noisy_trace(noise):
+    # 再接続毎にresetされるため、直後の20秒で普段の揺れに反応しないこと
+    detector = TrendDetector()
+    for seed in range(100):
+        rng = random.Random(seed)
+        detector.reset()
+        for _ in range(40):
+            assert not detector.add(_noisy(rng, noise)).degrading
+
+@pytest.mark.parametrize('noise', [0.1, 0.2])
+def test_no_alarm_on_long_flat_noisy_trace(noise):
+    rng = random.Random(7)
+    detector = TrendDetector()
+    # 0.5秒間隔で3時間分
+    alarms = sum(detector.add(_noisy(rng, noise)).degrading for _ in range(21600))
+    assert alarms == 0
+
+def test_no_alarm_during_warmup_even_on_drop():
+    detector = TrendDetector(warmup_sec=10)
+    states = [detector.add(BITRATE if i < 10 else 0) for i in range(19)]
+    assert not any(state.degrading for state in states)
+
+def test_detects_ramp_before_it_bottoms_out():
+    rng = random.Random(3)
+    detector = TrendDetector()
+    first = None
+    for i in range(200):
+        t = i * 0.5
+        base = BITRATE if t < 60 else max(0, BITRATE * (1 - (t - 60) / 6))
+        if detector.add(base * (1 + rng.gauss(0, 0.1))).degrading and t >= 60:
+            first = t
+            break
+    # 6秒かけて0まで落ちる、落ち切る前に検知すること
+    assert first is not None and first - 60 < 5
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from aiohttp import web
+from modules.webhook_client import AsyncWebhookClient
+
+async def _post(handler, data, wait, timeout_sec):
+    app = web.Application()
+    app.router.add_post('/webhook', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    client = AsyncWebhookClient(f'http://127.0.0.1:{port}', '/webhook', timeout_sec=timeout_sec)
+    try:
+        return await client.post(data, wait=wait)
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+def test_wait_limit_is_shorter_than_client_timeout():
+    received = []
+    async def handler(request):
+        data = await request.json()
+        received.append(data)
+        return web.json_response({**data, 'result': 'timeout', 'status': 'error'}, status=400)
+    response = asyncio.run(_post(handler, {'stream': 'start'}, True, timeout_sec=15))
+    assert received == [{'stream': 'start', 'wait': 13}]
+    assert response.timed_out
+
+def test_client_timeout_is_reported_as_timeout():
+    async def handler(request):
+        await asyncio.sleep(2)
+        return web.json_response({})
+    response = asyncio.run(_post(handler, {'stream': 'start'}, True, timeout_sec=0.5))
+    assert (response.status_code, response.timed_out) == (0, True)
+
+def test_connection_failure_is_not_timeout():
+    client = AsyncWebhookClient('http://127.0.0.1:1', '/webhook')
+    async def post():
+        try:
+            return await client.post({'stream': 'start'})
+        finally:
+            await client.close()
+    response = asyncio.run(post())
+    assert (response.status_code, response.timed_out) == (0, False)
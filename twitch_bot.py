@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
+import asyncio
 from twitchio import Channel, Message
 from twitchio.ext import commands
-import requests
 import json
 from modules.scheduler import Scheduler
 from modules.logger import LoggerConfig
+from modules.alerts import AlertCooldown, alert_message, ALERT_SCENE
+from modules.rate_limiter import create_rate_limiter, rejected_message, NOTICE_DELAY_SEC
+from modules.telemetry import TelemetryReader, status_message
+from modules.webhook_client import create_webhook_client
 
 class TwitchBot(commands.Bot):
 
-    def __init__(self, config_ini):
+    def __init__(self, config_ini, telemetry_name: str = None):
         super().__init__(
             initial_channels=[config_ini['twitch']['Login_Channel']],
             token=config_ini['twitch']['Access_Token'],
@@ -16,7 +20,19 @@ class TwitchBot(commands.Bot):
         )
         self.prefix = config_ini['twitch']['Command_Prefix']
         self.is_command_control = config_ini.getboolean('twitch', 'obs_command_control')
-        self.webhook_url = 'http://localhost:' + config_ini['http']['webhook_port'] + config_ini['http']['webhook_path']
+        # OBSの応答待ちでチャットの処理を止めないよう非同期で送る
+        self.webhook = create_webhook_client(config_ini)
+        # 監視の状態はweb appが書き込む共有メモリから読む
+        self.telemetry = TelemetryReader(telemetry_name)
+        # 荒らし等でOBSへの操作・返信が溢れないよう、ユーザー毎・コマンド毎・全体で回数を制限する
+        self.rate_limiter = create_rate_limiter(config_ini, 'twitch')
+        self._notice_task = None
+        # ビットレートの低下・回復とシーンの変化をチャットへ通知する
+        self.login_channel = config_ini['twitch']['Login_Channel']
+        self.is_alert = config_ini.getboolean('twitch', 'Alert', fallback=False)
+        self.is_scene_alert = config_ini.getboolean('twitch', 'Alert_Scene_Change', fallback=True)
+        self.alert_cooldown = AlertCooldown(config_ini.getfloat('twitch', 'Alert_Cooldown_Sec', fallback=60))
+        self._alert_task = None
 
         self.__auth_error_message = "権限がありません"
         self.__command_error_message = "コマンドを確認してください"
@@ -34,6 +50,25 @@ class TwitchBot(commands.Bot):
 
     async def event_ready(self):
         self.logger.info('started twitch bot!')
+        if self.is_alert and self._alert_task is None:
+            self._alert_task = asyncio.create_task(self.webhook.subscribe('/alerts/events', self._on_alert))
+
+    async def _on_alert(self, alert: dict):
+        if alert['kind'] == ALERT_SCENE and not self.is_scene_alert:
+            return
+        channel = self.get_channel(self.login_channel)
+        if channel is None or not self.alert_cooldown.should_send(channel.name, alert['kind']):
+            return
+        message = alert_message(alert)
+        if message:
+            await channel.send(message)
+
+    async def close(self):
+        if self._alert_task is not None:
+            self._alert_task.cancel()
+        await self.webhook.close()
+        self.telemetry.close()
+        await super().close()
 
     # コメントが書き込まれると呼び出される
     async def event_message(self, message: Message):
@@ -52,11 +87,19 @@ class TwitchBot(commands.Bot):
     async def cmd_hello(self, ctx: commands.Context):
         await ctx.send(f'Hello! {ctx.author.name}!')
 
+    # 配信・シーン・ビットレートの状態
+    @commands.command(name='status')
+    async def status(self, ctx: commands.Context):
+        await ctx.send(status_message(self.telemetry.read()))
+
     @commands.command(name='stream')
     async def stream(self, ctx: commands.Context, args=None):
         if not self.is_command_control:
             return
 
+        if not self._check_rate_limit(ctx, 'stream'):
+            return
+
         if not isinstance(args, str):
             await ctx.send(self.__command_error_message)
             return
@@ -73,6 +116,9 @@ class TwitchBot(commands.Bot):
         if not self.is_command_control:
             return
 
+        if not self._check_rate_limit(ctx, 'pause'):
+            return
+
         # if not isinstance(args, str):
         #     await ctx.send(self.__command_error_message)
         #     return
@@ -97,14 +143,14 @@ class TwitchBot(commands.Bot):
         }
 
         if command in valid_commands:
-            return self._post_to_webhook({'stream': valid_commands[command]}, self.webhook_url)
+            return await self._post_to_webhook({'stream': valid_commands[command]})
         return None
 
     async def _handle_pause_command(self, command: str):
         if command == 'on' or command is None:
-            return self._post_to_webhook({'pause': 'on'}, self.webhook_url)
+            return await self._post_to_webhook({'pause': 'on'})
         elif command == 'off':
-            return self._post_to_webhook({'pause': 'off'}, self.webhook_url)
+            return await self._post_to_webhook({'pause': 'off'})
         return None
 
     async def _process_response(self, ctx, response):
@@ -120,9 +166,24 @@ class TwitchBot(commands.Bot):
                 'pause': '待機を切り替えます'
             }.get(response.json().get('stream'), '操作完了')
             await ctx.send(message)
+        elif response.timed_out:
+            await ctx.send('OBSの応答待ちがタイムアウトしました(後から実行される場合があります)')
         else:
             await ctx.send('コマンドの実行に失敗しました')
 
+    # 配信者はユーザー毎の制限のみ、制限した分は後からまとめて1回だけ返信する
+    def _check_rate_limit(self, ctx, command: str):
+        if self.rate_limiter.allow(ctx.author.name, command, privileged=ctx.author.is_broadcaster):
+            return True
+        if self.rate_limiter.reject(ctx.author.name):
+            self._notice_task = asyncio.create_task(self._send_rate_limit_notice(ctx))
+        return False
+
+    async def _send_rate_limit_notice(self, ctx):
+        await asyncio.sleep(NOTICE_DELAY_SEC)
+        rejected, users = self.rate_limiter.flush()
+        await ctx.send(rejected_message(rejected, users))
+
     def _message_auth_check(self, message, auth_list):
         # auth_list [broadcaster, moderator, vip, subscriber, all]
         for auth in auth_list:
@@ -138,16 +199,9 @@ class TwitchBot(commands.Bot):
                 return True
         return False
 
-    def _post_to_webhook(self, data: dict, url: str) -> bool:
-        try:
-            response = requests.post(url, json=data)
-            response.raise_for_status()
-
-        except requests.RequestException as e:
-            print(f"Failed to send POST request: {e}")
-
-        finally:
-            return response
+    # OBSの操作が終わるまで待ち、結果をチャットに返す
+    async def _post_to_webhook(self, data: dict):
+        return await self.webhook.post(data, wait=True)
 
-def create(config):
-    return TwitchBot(config)
+def create(config, telemetry_name: str = None):
+    return TwitchBot(config, telemetry_name)
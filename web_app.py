@@ -1,84 +1,417 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify, make_response
+import json
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
 from obs_operator import OBSOperator
-from modules.rtmp_monitor import RTMPMonitor
-from modules.scheduler import Scheduler
+from modules.alerts import AlertFeed, BitrateAlertDetector, ALERT_SCENE
+from modules.binary_log import BinaryLogWriter, session_path, KIND_OBS, KIND_SCENE, KIND_STREAMING
+from modules.bitrate_history import downsample, DOWNSAMPLE_LTTB, DOWNSAMPLE_MINMAX
+from modules.broadcaster import Broadcaster
+from modules.obs_command_queue import OBSCommandQueue, COMMAND_QUEUED
+from modules.rtmp_monitor import RTMPMonitor, CachedResponse
 from modules.logger import LoggerConfig
 
 class WebApp:
-    def __init__(self, config_ini):
+    STATUS_TIMEOUT_SEC = 30 # /statusの長ポーリングの既定の待ち時間[sec]
+    STATUS_MAX_TIMEOUT_SEC = 60
+    HISTORY_POINTS = 500 # /historyの既定の点数
+    HISTORY_MAX_POINTS = 5000
+    WEBHOOK_WAIT_SEC = 30 # "wait"で結果を待つ上限[sec]、"wait"に秒数を指定した場合もこれを超えない
+    AUTO_SCENE_DEADLINE_SEC = 1 # 自動切替の判定を積んでから実行するまでの期限[sec]
+
+    def __init__(self, config_ini, start_monitors: bool = True, telemetry=None):
+        """
+        :param start_monitors: OBS・RTMPの監視を別スレッドで開始する、AsyncWebAppでは同じイベントループで動かすためFalse
+        :param telemetry: ボットのプロセスと共有するTelemetryWriter、Noneなら書き込まない
+        """
         self.webhook_port = config_ini['http']['webhook_port']
         self.webhook_path = config_ini['http']['webhook_path']
-        self.monitoring_interval = int(config_ini['http']['monitoring_interval'])
 
-        self.app = Flask(__name__)
-        CORS(self.app)
-        self.obs_operator = OBSOperator(config_ini)
+        self.obs_operator = OBSOperator(config_ini, start_monitor=start_monitors)
         self.rtmp_monitor = RTMPMonitor(
             rtmp_stat_url=config_ini['http']['monitoring_utl'],
-            streamkey=config_ini['obs']['streamkey'],
+            streamkey=[key.strip() for key in config_ini['obs']['streamkey'].split(',') if key.strip()],
             monitoring_interval_sec=0.5, # rtmp_statを監視する間隔、
-            average_bitrate_sec=5 # 平均ビットレートを計算する秒数、長すぎると自動切替等に影響
+            average_bitrate_sec=config_ini.getfloat('http', 'average_bitrate_sec', fallback=5), # 平均ビットレートを計算する秒数、長すぎると自動切替等に影響
+            windows_sec=[float(sec) for sec in config_ini.get('http', 'bitrate_windows', fallback='1,5,30,300').split(',') if sec.strip()],
+            connect_timeout_sec=config_ini.getfloat('http', 'stat_connect_timeout', fallback=1.0),
+            read_timeout_sec=config_ini.getfloat('http', 'stat_read_timeout', fallback=2.0),
+            bitrate_source=config_ini.get('http', 'bitrate_source', fallback='nginx'),
+            trend_window_sec=config_ini.getfloat('http', 'trend_window_sec', fallback=4),
+            trend_cusum_threshold=config_ini.getfloat('http', 'trend_cusum_threshold', fallback=8),
+            history_sec=config_ini.getfloat('http', 'history_hours', fallback=12) * 3600
         )
-        self.scheduler = Scheduler()
         self.logger = LoggerConfig.get_logger(self.__class__.__name__)
 
+        # OBS・RTMPを合わせた状態の版番号、/status?since=の長ポーリングで待つ
+        # ビットレートの値毎には進めず、起動・配信・シーン・受信の有無・低下の兆候が変わった時だけ進める
+        self.status_updates = Broadcaster()
+        self._status_lock = threading.Lock()
+        self._status_key = None
+        self.rtmp_monitor.updates.add_listener(self._on_state_changed)
+        self.obs_operator.obs_monitor.updates.add_listener(self._on_state_changed)
+        self._on_state_changed()
+
+        # ビットレートとOBSのイベントを起動毎のファイルに記録する、binary_log_dirが空なら記録しない
+        self.binary_log = None
+        binary_log_dir = config_ini.get('http', 'binary_log_dir', fallback='')
+        if binary_log_dir:
+            self._setup_binary_log(binary_log_dir, config_ini.getint('http', 'binary_log_keep', fallback=10))
+
+        # ボットの?status等はHTTPを介さず共有メモリから読む
+        self.telemetry = telemetry
+        if telemetry is not None:
+            self.rtmp_monitor.updates.add_listener(self._write_telemetry)
+            self.obs_operator.obs_monitor.updates.add_listener(self._write_telemetry)
+            self._write_telemetry()
+
+        # ビットレートの低下・回復とシーンの変化をボットへ通知する
+        self.alerts = AlertFeed()
+        alert_bitrate = config_ini.get('http', 'alert_bitrate', fallback='').strip()
+        self.bitrate_alert = BitrateAlertDetector(
+            threshold=float(alert_bitrate) if alert_bitrate else self.obs_operator.fail_bw,
+            drop_hold_sec=config_ini.getfloat('http', 'alert_drop_sec', fallback=3),
+            recover_hold_sec=config_ini.getfloat('http', 'alert_recover_sec', fallback=5)
+        )
+        self._alert_scene = None
+        self.rtmp_monitor.updates.add_listener(self._check_bitrate_alert)
+        self.obs_operator.obs_monitor.updates.add_listener(self._check_scene_alert)
+
+        # OBSへの操作は全てこのキューを通し、1つずつ実行する
+        self.obs_commands = OBSCommandQueue()
+        self.obs_commands.start()
+
         self._setup_routes()
-        self._setup_scheduler()
-        self.rtmp_monitor.run()
+        self._start_scene_control()
+        if start_monitors:
+            self.rtmp_monitor.run()
 
         self.logger.info('Started Web App!')
 
     # webhookによる切替操作
     def _setup_routes(self):
+        self.app = Flask(__name__)
+        CORS(self.app)
+
         @self.app.route(self.webhook_path, methods=['POST'])
         def webhook():
-            data = request.json
-            response = None
-            if "stream" in data:
-                response = self._handle_stream_action(data.get("stream"), data)
-            elif "pause" in data:
-                response = self._handle_pause_action(data.get("pause"))
-            elif "cmd" in data:
-                response = self._handle_cmd_action(data.get("cmd"), data)
-                if response:
-                    data |= response
-            if response:
-                return self._create_response(data, success=True)
-            else:
-                return self._create_response(data, success=False)
+            data, success = self._handle_webhook(request.json)
+            return self._create_response(data, success=success)
 
+        # ?stream=<ストリーム名>で対象を指定、省略時はメインのストリーム
+        # 監視毎に作成済みのJSONを返す、If-None-Matchが一致すれば304
         @self.app.route('/bitrate', methods=['GET'])
         def bitrate():
-            res = make_response(jsonify({'bitrate': str(self.rtmp_monitor.bw_in)}), 200)
-            res.headers['Content-Type'] = 'application/json'
-            return res
+            cached = self._bitrate_response(request.args.get('stream'))
+            return self._create_cached_response(cached, request.headers.get('If-None-Match'))
 
+        # ?window=<秒>で平均する時間窓を指定、省略時はaverage_bitrate_sec
         @self.app.route('/avg_bitrate', methods=['GET'])
         def avg_bitrate():
-            res = make_response(jsonify({'bitrate': str(self.rtmp_monitor.avg_bw_in)}), 200)
+            window_sec = request.args.get('window', type=float)
+            if window_sec is not None and window_sec not in self.rtmp_monitor.windows_sec:
+                return self._create_response({'window': window_sec, 'windows': self.rtmp_monitor.windows_sec}, success=False)
+            cached = self._avg_bitrate_response(request.args.get('stream'), window_sec)
+            return self._create_cached_response(cached, request.headers.get('If-None-Match'))
+
+        # Server-Sent Events、監視毎に{"stream", "bitrate", "avg_bitrate"}を送る
+        @self.app.route('/bitrate/events', methods=['GET'])
+        def bitrate_events():
+            stream_name = request.args.get('stream') or self.rtmp_monitor.streamkey
+            res = Response(
+                stream_with_context(self._bitrate_event_stream(stream_name)),
+                mimetype='text/event-stream'
+            )
+            res.headers['Cache-Control'] = 'no-cache'
+            res.headers['X-Accel-Buffering'] = 'no'
+            return res
+
+        # Server-Sent Events、ビットレートの低下・回復とシーンの変化を送る
+        # 再接続時はLast-Event-IDより後の通知から送る
+        @self.app.route('/alerts/events', methods=['GET'])
+        def alert_events():
+            res = Response(
+                stream_with_context(self._alert_event_stream(self._alert_start_id(request.headers.get('Last-Event-ID')))),
+                mimetype='text/event-stream'
+            )
+            res.headers['Cache-Control'] = 'no-cache'
+            res.headers['X-Accel-Buffering'] = 'no'
+            return res
+
+        # 全時間窓の平均・EWMA・最小/最大・分位点
+        @self.app.route('/bitrate_stats', methods=['GET'])
+        def bitrate_stats():
+            res = make_response(jsonify(self._bitrate_stats_data(request.args.get('stream'))), 200)
             res.headers['Content-Type'] = 'application/json'
             return res
 
+        # ?from=&to=(UNIX時刻[sec])の範囲を?points=点に間引いて返す、?method=lttb or minmax
+        @self.app.route('/history', methods=['GET'])
+        def history():
+            data = self._history_data(
+                request.args.get('stream'),
+                request.args.get('from', type=float),
+                request.args.get('to', type=float),
+                request.args.get('points', default=self.HISTORY_POINTS, type=int),
+                request.args.get('method', default=DOWNSAMPLE_LTTB)
+            )
+            if data is None:
+                return self._create_response({'methods': [DOWNSAMPLE_LTTB, DOWNSAMPLE_MINMAX]}, success=False)
+            return make_response(jsonify(data), 200)
+
+        # ?since=<版番号>を指定すると状態が変わるまで(最大?timeout=秒)待ってから返す
+        @self.app.route('/status', methods=['GET'])
+        def status():
+            since, timeout = self._status_wait_params(
+                request.args.get('since', type=int),
+                request.args.get('timeout', default=self.STATUS_TIMEOUT_SEC, type=float)
+            )
+            if since is not None:
+                self.status_updates.wait(since, timeout)
+            res = make_response(jsonify(self._get_stream_status()), 200)
+            res.headers['Cache-Control'] = 'no-cache'
+            return res
+
+    # 以下はFlask/aiohttpで共通の処理
+    def _handle_webhook(self, data):
+        """
+        :return: (レスポンスのデータ, 成否)
+        """
+        if "cmd" in data:
+            response = self._handle_cmd_action(data.get("cmd"), data)
+            if response:
+                data |= response
+            return data, bool(response)
+
+        command = None
+        if "stream" in data:
+            name = f"stream {data.get('stream')}"
+            command = self._stream_command(data.get("stream"), data)
+        elif "pause" in data:
+            name = f"pause {data.get('pause')}"
+            command = self._pause_command(data.get("pause"))
+        if command is None:
+            return data, False
+        func, key, deadline_sec, is_noop = command
+        future = self.obs_commands.submit(name, func, key=key, deadline_sec=deadline_sec, is_noop=is_noop)
+        # 既定では受け付けた時点で返す、"wait": trueか秒数ならOBSの操作が終わるまで待つ
+        wait = data.get("wait")
+        if not wait:
+            return {**data, "result": COMMAND_QUEUED}, True
+        # 呼び出し側が先に諦めないよう、秒数が指定された場合はその時間で"timeout"を返す
+        wait_sec = self.WEBHOOK_WAIT_SEC
+        if isinstance(wait, (int, float)) and not isinstance(wait, bool):
+            wait_sec = min(max(wait, 0), self.WEBHOOK_WAIT_SEC)
+        try:
+            result = future.result(timeout=wait_sec)
+        except FutureTimeoutError:
+            return {**data, "result": "timeout"}, False
+        return {**data, "result": result.status}, result.ok
+
+    _NO_STREAM_RESPONSE = CachedResponse(b'{"bitrate":"0"}', '"no-stream"')
+
+    def _bitrate_response(self, stream_name):
+        snapshot = self.rtmp_monitor.snapshot
+        return snapshot.bitrate.get(stream_name or self.rtmp_monitor.streamkey, self._NO_STREAM_RESPONSE)
+
+    def _avg_bitrate_response(self, stream_name, window_sec):
+        snapshot = self.rtmp_monitor.snapshot
+        key = (stream_name or self.rtmp_monitor.streamkey, window_sec or self.rtmp_monitor.average_bitrate_sec)
+        return snapshot.avg_bitrate.get(key, self._NO_STREAM_RESPONSE)
+
+    def _is_not_modified(self, cached, if_none_match):
+        if not if_none_match:
+            return False
+        etags = [etag.strip() for etag in if_none_match.split(',')]
+        return '*' in etags or cached.etag in etags or f'W/{cached.etag}' in etags
 
-    def _handle_stream_action(self, action, data):
+    def _bitrate_stats_data(self, stream_name):
+        sample = self.rtmp_monitor.sample(stream_name)
+        return {
+            'stream': sample.name if sample else stream_name,
+            'bitrate': sample.bw_in if sample else 0,
+            'windows': sample.windows if sample else {},
+            'trend': sample.trend._asdict() if sample else {}
+        }
+
+    def _history_data(self, stream_name, start, end, points, method):
+        """
+        :return: 列毎の配列、methodが不正な場合はNone
+        """
+        if method not in (DOWNSAMPLE_LTTB, DOWNSAMPLE_MINMAX):
+            return None
+        stream_name = stream_name or self.rtmp_monitor.streamkey
+        points = min(max(points, 2), self.HISTORY_MAX_POINTS)
+        history = self.rtmp_monitor.get_history(stream_name)
+        timestamps, bitrates, avg_bitrates = history.range(start, end) if history else ([], [], [])
+        samples = len(timestamps)
+        timestamps, bitrates, avg_bitrates = downsample(timestamps, bitrates, avg_bitrates, points, method)
+        return {
+            'stream': stream_name,
+            'method': method,
+            'samples': samples,
+            'time': [round(t, 2) for t in timestamps],
+            'bitrate': bitrates,
+            'avg_bitrate': avg_bitrates
+        }
+
+    def _format_bitrate_event(self, version, snapshot, stream_name):
+        payload = snapshot.events.get(stream_name) if snapshot else None
+        if payload is None:
+            return None
+        return b'id: %d\ndata: %s\n\n' % (version, payload)
+
+    def _bitrate_event_stream(self, stream_name, keepalive_sec=15):
+        yield b'retry: 3000\n\n'
+        version = 0
+        while True:
+            new_version, snapshot = self.rtmp_monitor.updates.wait(version, timeout=keepalive_sec)
+            if new_version == version:
+                yield b': keepalive\n\n'
+                continue
+            version = new_version
+            event = self._format_bitrate_event(version, snapshot, stream_name)
+            if event is not None:
+                yield event
+
+    def _alert_start_id(self, last_event_id):
+        # 指定が無い・再起動で番号が戻った場合は、接続以降の通知から送る
+        version = self.alerts.updates.version
+        if last_event_id is None or not last_event_id.isdigit() or int(last_event_id) > version:
+            return version
+        return int(last_event_id)
+
+    def _format_alert_event(self, alert):
+        return b'id: %d\ndata: %s\n\n' % (alert.id, json.dumps(alert._asdict()).encode())
+
+    def _alert_event_stream(self, alert_id, keepalive_sec=15):
+        yield b'retry: 3000\n\n'
+        while True:
+            new_version, _ = self.alerts.updates.wait(alert_id, timeout=keepalive_sec)
+            if new_version == alert_id:
+                yield b': keepalive\n\n'
+                continue
+            for alert in self.alerts.since(alert_id):
+                yield self._format_alert_event(alert)
+            alert_id = new_version
+
+    def _check_bitrate_alert(self, version, snapshot):
+        # 配信していない間は通知しない
+        obs_state = self.obs_operator.obs_monitor.state
+        if not obs_state.streaming:
+            self.bitrate_alert.reset()
+            return
+        sample = snapshot.streams[self.rtmp_monitor.streamkey]
+        result = self.bitrate_alert.update(snapshot.timestamp, sample.bw_in)
+        if result is not None:
+            kind, duration = result
+            self.alerts.publish(kind, sample.name, sample.bw_in, self.bitrate_alert.threshold, duration, obs_state.scene)
+
+    def _check_scene_alert(self, version, state):
+        previous, self._alert_scene = self._alert_scene, state.scene
+        if state.streaming and previous is not None and state.scene and state.scene != previous:
+            self.alerts.publish(ALERT_SCENE, scene=state.scene)
+
+    def _on_state_changed(self, *_):
+        # RTMP監視・OBSの受信スレッドから呼ばれる
+        obs_state = self.obs_operator.obs_monitor.state
+        sample = self.rtmp_monitor.sample()
+        key = (obs_state.running, obs_state.streaming, obs_state.scene, sample.bw_in > 0, sample.trend.degrading)
+        with self._status_lock:
+            if key == self._status_key:
+                return
+            self._status_key = key
+            self.status_updates.publish(key)
+
+    def _setup_binary_log(self, directory, keep):
+        path = session_path(directory, keep)
+        self.binary_log = BinaryLogWriter(path, self.rtmp_monitor.streamkeys)
+        self._logged_obs_state = None
+        self.rtmp_monitor.updates.add_listener(self._log_bitrate)
+        self.obs_operator.obs_monitor.updates.add_listener(self._log_obs_state)
+        self._log_obs_state(None, self.obs_operator.obs_monitor.state)
+        self.logger.info(f'Recording bitrate log to {path}')
+
+    def _log_bitrate(self, version, snapshot):
+        for name, sample in snapshot.streams.items():
+            self.binary_log.write_sample(name, sample.bw_in, sample.avg_bw_in, sample.stat is not None)
+
+    def _log_obs_state(self, version, state):
+        # 変わった値だけをイベントとして記録する
+        previous = self._logged_obs_state
+        self._logged_obs_state = state
+        if previous is None or previous.running != state.running:
+            self.binary_log.write_event(KIND_OBS, int(state.running))
+        if previous is None or previous.streaming != state.streaming:
+            self.binary_log.write_event(KIND_STREAMING, int(state.streaming))
+        if previous is None or previous.scene != state.scene:
+            self.binary_log.write_event(KIND_SCENE, text=state.scene or '')
+
+    def _write_telemetry(self, *_):
+        # _on_state_changedの後に呼ばれるため、versionは/statusと揃う
+        obs_state = self.obs_operator.obs_monitor.state
+        sample = self.rtmp_monitor.sample()
+        self.telemetry.write(
+            version=self.status_updates.version,
+            bw_in=sample.bw_in,
+            avg_bw_in=sample.avg_bw_in,
+            trend_confidence=sample.trend.confidence,
+            running=obs_state.running,
+            streaming=obs_state.streaming,
+            receiving=sample.bw_in > 0,
+            degrading=sample.trend.degrading,
+            scene=obs_state.scene
+        )
+
+    def _status_wait_params(self, since, timeout):
+        """
+        :return: (since, timeout)、待たずに返す場合のsinceはNone
+        """
+        # 再起動で版番号が戻った場合も待たずに現在の状態を返す
+        if since is not None and since > self.status_updates.version:
+            since = None
+        return since, min(max(timeout, 0), self.STATUS_MAX_TIMEOUT_SEC)
+
+    # 操作毎に(実行する関数, まとめる単位, 期限[sec], 送らなくてよいかの判定)を返す
+    # シーンを切り替える操作は同じ単位とし、連続した場合は最後の操作だけを送る
+    def _stream_command(self, action, data):
         stream_actions = {
-            "start": self.obs_operator.stream_start,
-            "stop": self.obs_operator.stream_stop,
-            "live": self.obs_operator.stream_to_live,
-            "pause": self.obs_operator.scene_switch_pause,
-            "text": lambda: self.obs_operator.set_text_source('bitrate', data['content']),
-            "init": self.obs_operator.stream_initialize,
+            "start": (self.obs_operator.stream_start, None, 10, None),
+            "stop": (self.obs_operator.stream_stop, None, 10, self._is_not_streaming),
+            "live": (self.obs_operator.stream_to_live, 'scene', 3, lambda: self._streaming_scene() == 'live'),
+            "pause": self._pause_toggle_command(),
+            "text": (lambda: self.obs_operator.set_text_source('bitrate', data['content']), 'text', 2, None),
+            "init": (self.obs_operator.stream_initialize, 'scene', 3, None),
         }
-        return stream_actions.get(action)()
+        return stream_actions.get(action)
 
-    def _handle_pause_action(self, action):
+    def _pause_command(self, action):
         pause_actions = {
-            "on": self.obs_operator.scene_set_pause_on,
-            "off": self.obs_operator.scene_set_pause_off,
+            "on": (self.obs_operator.scene_set_pause_on, 'scene', 3, lambda: self._streaming_scene() == 'pause'),
+            "off": (self.obs_operator.scene_set_pause_off, 'scene', 3, lambda: self._streaming_scene() not in (None, 'pause')),
         }
-        return pause_actions.get(action)()
+        return pause_actions.get(action)
+
+    # 切替はまとめると結果が積まれた数の偶奇で変わるため、受け付けた時点のシーンでon/offに置き換える
+    # 配信中でない等で判定できない場合はまとめずに送る
+    def _pause_toggle_command(self):
+        scene = self._streaming_scene()
+        if scene is None:
+            return self.obs_operator.scene_switch_pause, None, 3, None
+        return self._pause_command('off' if scene == 'pause' else 'on')
+
+    def _is_not_streaming(self):
+        state = self.obs_operator.obs_monitor.state
+        return state.running and not state.streaming
+
+    # 配信中のシーンのscene_dictのキー、配信中でない・該当しない場合はNone
+    def _streaming_scene(self):
+        state = self.obs_operator.obs_monitor.state
+        if not (state.running and state.streaming):
+            return None
+        return self.obs_operator._get_scene_id(state.scene)
 
     def _handle_cmd_action(self, action, data):
         cmd_actions = {
@@ -95,38 +428,79 @@ class WebApp:
         res.headers['Content-Type'] = 'application/json'
         return res
 
-    def _setup_scheduler(self):
-        self.scheduler.add_interval_job_condition(
-            func=self._stream_scene_control,
-            condition_func=self._check_stream_status,
-            seconds=self.monitoring_interval,
-            job_id="scene_control",
-        )
-
-    def _check_stream_status(self):
-        return self.obs_operator.scene_swich_check()
+    def _create_cached_response(self, cached, if_none_match):
+        if self._is_not_modified(cached, if_none_match):
+            res = Response(status=304)
+        else:
+            res = Response(cached.body, status=200, mimetype='application/json')
+        res.headers['ETag'] = cached.etag
+        res.headers['Cache-Control'] = 'no-cache'
+        return res
 
     # bitrate監視によるシーン切り替え
-    def _stream_scene_control(self):
+    # RTMPの監視毎に判定する、OBSの応答待ちで監視ループを止めないようOBSのコマンドキューで行う
+    def _start_scene_control(self):
+        # 低下の兆候は検知した1サンプルにしか出ない(検知後は基準値を取り直す)ため、
+        # まとめて捨てた・期限切れのサンプルの兆候は次に実行する判定に引き継ぐ
+        self._auto_scene_degrading = False
+        self._auto_scene_lock = threading.Lock()
+        self.rtmp_monitor.updates.add_listener(self._submit_scene_control)
+
+    def _submit_scene_control(self, version, snapshot):
+        sample = snapshot.streams.get(self.rtmp_monitor.streamkey)
+        if sample is not None and sample.trend.degrading:
+            with self._auto_scene_lock:
+                self._auto_scene_degrading = True
+        # 処理中に届いたサンプルはまとめ、最新のものだけで判定する
+        return self.obs_commands.submit(
+            'auto_scene', lambda: self._stream_scene_control(snapshot),
+            key='auto_scene', deadline_sec=self.AUTO_SCENE_DEADLINE_SEC
+        )
+
+    def _stream_scene_control(self, snapshot):
+        with self._auto_scene_lock:
+            degrading, self._auto_scene_degrading = self._auto_scene_degrading, False
+        sample = snapshot.streams[self.rtmp_monitor.streamkey]
         self.obs_operator.scene_switch_by_bitrate(
-            bitrate=self.rtmp_monitor.bw_in,
-            avg_bitrate=self.rtmp_monitor.avg_bw_in
+            bitrate=sample.bw_in,
+            avg_bitrate=sample.avg_bw_in,
+            timestamp=snapshot.timestamp,
+            trend=sample.trend._replace(degrading=True) if degrading else sample.trend
         )
 
     def _get_stream_status(self):
+        # 各監視の状態はそれぞれ1回だけ読み、値の組み合わせを揃える
+        obs_state = self.obs_operator.obs_monitor.state
+        sample = self.rtmp_monitor.sample()
         data = {
-            "obs": self.obs_operator.obs_monitor.is_obs_running,
-            "streaming": self.obs_operator.obs_monitor.is_obs_streaming,
-            "scene": self.obs_operator.obs_monitor.scene_name,
-            "avg_bitrate": self.rtmp_monitor.avg_bw_in
+            "obs": obs_state.running,
+            "streaming": obs_state.streaming,
+            "scene": obs_state.scene,
+            "receiving": sample.bw_in > 0,
+            "avg_bitrate": sample.avg_bw_in,
+            "degrading": sample.trend.degrading,
+            "trend_confidence": sample.trend.confidence,
+            "version": self.status_updates.version,
+            "stat_latency_ms": self.rtmp_monitor.latency_ms,
+            "obs_latency_ms": self.obs_operator.obs_monitor.liveness_latency_ms
         }
         return data
 
     def run(self):
-        self.app.run(
-            host='0.0.0.0',
-            port=self.webhook_port
-        )
+        try:
+            self.app.run(
+                host='0.0.0.0',
+                port=self.webhook_port
+            )
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.rtmp_monitor.stop()
+        self.obs_commands.stop(timeout=5)
+        self.obs_operator.close()
+        if self.binary_log is not None:
+            self.binary_log.close()
 
 # ファイルが直接実行されたときだけサーバーを起動
 if __name__ == '__main__':